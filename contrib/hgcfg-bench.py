@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+#
+# hgcfg-bench.py - benchmarks for the hgcfg extension
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Benchmarks the hot paths of the hgcfg extension against a synthetic set of
+config files.
+
+A global, user and local (repository) config file are generated in a
+temporary directory, with the given number of sections, keys per section and
+commented-out lines per section, and a chain of `%include`d files of the given
+depth. hgcfg is then imported from this source tree and run in-process
+against the local Mercurial install, without network access. The in-memory
+cache kept by long-running processes ("hgcfg.warm-cache-size") is turned off.
+
+Results are written as JSON, and can be compared with those of an earlier run:
+
+    python contrib/hgcfg-bench.py --output before.json
+    (make changes)
+    python contrib/hgcfg-bench.py --output after.json --compare before.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    _clock = time.perf_counter
+except AttributeError:
+    _clock = time.time
+
+HGEXT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                     os.pardir, 'hgext')
+
+
+def writerc(path, prefix, args, include=None):
+    """
+    Writes a synthetic config file, optionally `%include`-ing another.
+    """
+    with open(path, 'w') as f:
+        for s in range(args.sections):
+            f.write('[%s%d]\n' % (prefix, s))
+            for k in range(args.keys):
+                f.write('key%d = %s value %d.%d\n' % (k, prefix, s, k))
+                if k < args.comments:
+                    f.write(';key%d = old %s value %d.%d\n' % (k, prefix, s, k))
+            for c in range(args.comments - min(args.comments, args.keys)):
+                f.write('# comment %d\n' % c)
+            f.write('\n')
+        f.write('[shared]\nkey = %s\n' % prefix)
+        if include is not None:
+            f.write('%%include %s\n' % include)
+
+
+def makecorpus(root, args):
+    """
+    Generates the config files under `root`, and returns a dict with their
+    paths.
+    """
+    paths = {
+        'home': os.path.join(root, 'home'),
+        'repo': os.path.join(root, 'repo'),
+        'global': os.path.join(root, 'global.rc'),
+    }
+    os.makedirs(paths['home'])
+    paths['user'] = os.path.join(paths['home'], '.hgrc')
+
+    include = None
+    for depth in reversed(range(args.include_depth)):
+        path = os.path.join(root, 'include%d.rc' % depth)
+        writerc(path, 'include%d_' % depth, args, include)
+        include = path
+
+    writerc(paths['global'], 'global', args, include)
+    writerc(paths['user'], 'user', args)
+    return paths
+
+
+def timeit(func, repeat):
+    """
+    Runs `func` `repeat` times and returns statistics about how long it took,
+    in seconds.
+    """
+    times = []
+    for i in range(repeat):
+        start = _clock()
+        func()
+        times.append(_clock() - start)
+    times.sort()
+    return {
+        'runs': repeat,
+        'min': times[0],
+        'median': times[len(times) // 2],
+        'mean': sum(times) / len(times),
+    }
+
+
+def benchmarks(hgcfg, ui, repo, paths, args):
+    """
+    Returns a list of `(name, func)` pairs to time.
+    """
+    from mercurial import pycompat
+
+    globalrc = pycompat.fsencode(paths['global'])
+    section = b'global%d' % (args.sections - 1)
+    key = b'key%d' % (args.keys - 1)
+    scopes = {b'local', b'user', b'global'}
+
+    def quiet(q):
+        u = repo.ui.copy()
+        u.setconfig(b'ui', b'quiet', q and b'yes' or b'no', b'hgcfg-bench')
+        return u
+
+    loud = quiet(False)
+    silent = quiet(True)
+
+    def showvalue(u, section, key):
+        def func():
+            u.pushbuffer()
+            hgcfg.showvalue(u, repo, section, key, scopes)
+            u.popbuffer()
+        return func
+
+    def listcfgs():
+        loud.pushbuffer()
+        hgcfg.listcfgs(loud, repo, repos=b'', jobs=1, template=b'')
+        loud.popbuffer()
+
+    # Writes go to a copy, so that every run rewrites a file of the same size.
+    scratch = os.path.join(os.path.dirname(paths['global']), 'scratch.rc')
+    shutil.copyfile(paths['global'], scratch)
+    scratch = pycompat.fsencode(scratch)
+    values = [b'a', b'b']
+
+    def writevaluetofile():
+        values.reverse()
+        hgcfg.writevaluetofile_(ui, repo, section, key, values[0], scratch,
+                                True)
+
+    return [
+        ('getconfigs', lambda: hgcfg.getconfigs(ui, repo)),
+        ('getvalues', lambda: hgcfg.getvalues(ui, section, key, globalrc)),
+        ('showvalue.sections', showvalue(loud, None, None)),
+        ('showvalue.sections.quiet', showvalue(silent, None, None)),
+        ('showvalue.section', showvalue(loud, section, None)),
+        ('showvalue.section.quiet', showvalue(silent, section, None)),
+        ('showvalue.key', showvalue(loud, section, key)),
+        ('writevaluetofile_', writevaluetofile),
+        ('listcfgs', listcfgs),
+    ]
+
+
+def compare(results, path):
+    """
+    Prints how the given results compare to those in the named file.
+    """
+    with open(path) as f:
+        old = json.load(f)['results']
+    print('%-28s %12s %12s %8s' % ('benchmark', 'before', 'after', 'ratio'))
+    for name in sorted(results):
+        new = results[name]['median']
+        if name not in old:
+            print('%-28s %12s %12.6f %8s' % (name, '-', new, '-'))
+            continue
+        before = old[name]['median']
+        ratio = new / before if before else float('inf')
+        print('%-28s %12.6f %12.6f %7.2fx' % (name, before, new, ratio))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--sections', type=int, default=50,
+                        help='sections per config file (default: %(default)s)')
+    parser.add_argument('--keys', type=int, default=20,
+                        help='keys per section (default: %(default)s)')
+    parser.add_argument('--comments', type=int, default=5,
+                        help='commented-out lines per section '
+                             '(default: %(default)s)')
+    parser.add_argument('--include-depth', type=int, default=2,
+                        help='depth of the chain of %%include-d files from '
+                             'the global config (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='runs of each benchmark (default: %(default)s)')
+    parser.add_argument('--only', action='append', default=[],
+                        help='only run benchmarks whose name starts with '
+                             'this (can be repeated)')
+    parser.add_argument('--output', default='hgcfg-bench.json',
+                        help='where to write the results '
+                             '(default: %(default)s)')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare with the results of an earlier run')
+    args = parser.parse_args(argv)
+
+    root = tempfile.mkdtemp(prefix='hgcfg-bench-')
+    try:
+        paths = makecorpus(root, args)
+
+        # This must be in place before Mercurial is imported, which may take
+        # a snapshot of the environment.
+        os.environ['HOME'] = paths['home']
+        os.environ['HGRCPATH'] = os.pathsep.join([paths['global'],
+                                                  paths['user']])
+        os.environ.pop('HGPLAIN', None)
+
+        sys.path.insert(0, os.path.abspath(HGEXT))
+        import hgcfg
+        from mercurial import hg, pycompat, ui as uimod, util
+
+        ui = uimod.ui.load()
+        # Every run must do the work of a command run on its own, which keeps
+        # nothing in memory from the run before.
+        ui.setconfig(b'hgcfg', b'warm-cache-size', b'0', b'hgcfg-bench')
+        repo = hg.repository(ui, pycompat.fsencode(paths['repo']), create=True)
+        writerc(os.path.join(paths['repo'], '.hg', 'hgrc'), 'local', args)
+        repo = hg.repository(ui, pycompat.fsencode(paths['repo']))
+
+        results = {}
+        for name, func in benchmarks(hgcfg, repo.ui, repo, paths, args):
+            if args.only and not any(name.startswith(o) for o in args.only):
+                continue
+            results[name] = timeit(func, args.repeat)
+            print('%-28s %12.6f' % (name, results[name]['median']))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'meta': {
+                'time': time.time(),
+                'python': platform.python_version(),
+                'mercurial': pycompat.sysstr(util.version()),
+                'sections': args.sections,
+                'keys': args.keys,
+                'comments': args.comments,
+                'include_depth': args.include_depth,
+            },
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
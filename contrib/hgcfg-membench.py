@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+#
+# hgcfg-membench.py - memory benchmark for the hgcfg extension
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Measures how much memory hgcfg needs to hold the configs of many repositories
+at once, as a fleet audit does.
+
+A global and a user config file, and the given number of repositories with a
+config file of their own, are generated in a temporary directory. Most values
+in the repositories' config files are the same in all of them, as they tend to
+be in a fleet. hgcfg is then imported from the given source tree (by default,
+this one), and the config files and parsed configs of every repository are
+loaded and kept. The growth of the resident set size, and optionally the size
+of what the Python allocator traced, is reported per 1,000 repositories.
+
+Results are written as JSON, and can be compared with those of an earlier run,
+or of another source tree:
+
+    python contrib/hgcfg-membench.py --hgext /path/to/old/hgext --output before.json
+    python contrib/hgcfg-membench.py --output after.json --compare before.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+HGEXT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                     os.pardir, 'hgext')
+
+
+def writerc(path, n, args):
+    """
+    Writes the config file of the `n`th repository.
+    """
+    with open(path, 'w') as f:
+        f.write('[paths]\n')
+        f.write('default = https://hg.example.com/repo%d\n' % n)
+        f.write('default-push = ssh://hg.example.com//srv/repo%d\n' % n)
+        f.write('\n[ui]\nusername = Build Bot <build@example.com>\n')
+        f.write('ignore = ~/.hgignore\n')
+        for s in range(args.sections):
+            f.write('\n[section%d]\n' % s)
+            for k in range(args.keys):
+                f.write('key%d = shared value %d.%d\n' % (k, s, k))
+                f.write(';key%d = old value %d.%d\n' % (k, s, k))
+        f.write('\n[hooks]\nchangegroup.notify = python:hgext.notify.hook\n')
+
+
+def makecorpus(root, args):
+    """
+    Generates the config files and repositories under `root`, and returns a
+    dict with their paths.
+    """
+    paths = {
+        'home': os.path.join(root, 'home'),
+        'global': os.path.join(root, 'global.rc'),
+        'repos': [],
+    }
+    os.makedirs(paths['home'])
+    paths['user'] = os.path.join(paths['home'], '.hgrc')
+    writerc(paths['global'], -1, args)
+    writerc(paths['user'], -2, args)
+    for n in range(args.repos):
+        repo = os.path.join(root, 'repo%d' % n)
+        os.makedirs(os.path.join(repo, '.hg'))
+        with open(os.path.join(repo, '.hg', 'requires'), 'w') as f:
+            f.write('store\n')
+        writerc(os.path.join(repo, '.hg', 'hgrc'), n, args)
+        paths['repos'].append(repo)
+    return paths
+
+
+def rss():
+    """
+    Returns the resident set size of this process, in bytes.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        import resource
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage if sys.platform == 'darwin' else usage * 1024
+
+
+def load(hgcfg, ui, repos):
+    """
+    Loads and parses the config files of every repository, like a fleet audit
+    holding them all at once, and returns what was loaded.
+    """
+    from mercurial import pycompat
+
+    class fakerepo(object):
+        def __init__(self, path):
+            self.path = pycompat.fsencode(os.path.join(path, '.hg'))
+
+    loaded = []
+    for path in repos:
+        configs = hgcfg.getconfigs(ui, fakerepo(path))
+        index = hgcfg.configindex(configs)
+        parsed = [index.parsed(c) for c in configs if c[b'exists']]
+        loaded.append((configs, parsed))
+    return loaded
+
+
+def compare(results, path):
+    """
+    Prints how the given results compare to those in the named file.
+    """
+    with open(path) as f:
+        old = json.load(f)['results']
+    print('%-28s %14s %14s %8s' % ('per 1000 repos', 'before', 'after', 'ratio'))
+    for name in sorted(results):
+        new = results[name]
+        if name not in old:
+            print('%-28s %14s %14d %8s' % (name, '-', new, '-'))
+            continue
+        before = old[name]
+        ratio = float(new) / before if before else float('inf')
+        print('%-28s %14d %14d %7.2fx' % (name, before, new, ratio))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--repos', type=int, default=1000,
+                        help='repositories to load (default: %(default)s)')
+    parser.add_argument('--sections', type=int, default=10,
+                        help='extra sections per config file '
+                             '(default: %(default)s)')
+    parser.add_argument('--keys', type=int, default=10,
+                        help='keys per extra section (default: %(default)s)')
+    parser.add_argument('--traced', action='store_true',
+                        help='also measure with tracemalloc, which is slower')
+    parser.add_argument('--hgext', default=HGEXT,
+                        help='the directory to import hgcfg from '
+                             '(default: this source tree)')
+    parser.add_argument('--output', default='hgcfg-membench.json',
+                        help='where to write the results '
+                             '(default: %(default)s)')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare with the results of an earlier run')
+    args = parser.parse_args(argv)
+
+    root = tempfile.mkdtemp(prefix='hgcfg-membench-')
+    try:
+        paths = makecorpus(root, args)
+
+        # This must be in place before Mercurial is imported, which may take
+        # a snapshot of the environment.
+        os.environ['HOME'] = paths['home']
+        os.environ['HGRCPATH'] = os.pathsep.join([paths['global'],
+                                                  paths['user']])
+        os.environ.pop('HGPLAIN', None)
+
+        sys.path.insert(0, os.path.abspath(args.hgext))
+        import hgcfg
+        from mercurial import pycompat, ui as uimod, util
+
+        ui = uimod.ui.load()
+
+        # Warm up with a few repositories, so that what is only loaded once
+        # isn't counted.
+        load(hgcfg, ui, paths['repos'][:2])
+        gc.collect()
+        scale = 1000.0 / args.repos
+
+        before = rss()
+        loaded = load(hgcfg, ui, paths['repos'])
+        gc.collect()
+        results = {'rss': int((rss() - before) * scale)}
+        del loaded
+        gc.collect()
+
+        if args.traced:
+            import tracemalloc
+            tracemalloc.start()
+            start = tracemalloc.get_traced_memory()[0]
+            loaded = load(hgcfg, ui, paths['repos'])
+            gc.collect()
+            traced = tracemalloc.get_traced_memory()[0] - start
+            tracemalloc.stop()
+            results['traced'] = int(traced * scale)
+            del loaded
+
+        for name in sorted(results):
+            print('%-28s %14d' % (name, results[name]))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'meta': {
+                'time': time.time(),
+                'python': platform.python_version(),
+                'mercurial': pycompat.sysstr(util.version()),
+                'hgext': os.path.abspath(args.hgext),
+                'repos': args.repos,
+                'sections': args.sections,
+                'keys': args.keys,
+            },
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
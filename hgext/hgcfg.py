@@ -42,28 +42,39 @@ hgcfg
 Displays or modifies local, user, and global configuration.
 """
 
+import bisect
+import collections
+import errno
+import functools
+import hashlib
+import itertools
+import marshal
 import re
 import os.path
+import signal
 import sys
+import threading
+import time
 
-from mercurial import util, cmdutil
-from mercurial.config import config as config_file
+from mercurial import encoding, error, formatter, hg, pycompat, util, cmdutil
+from mercurial import commands, extensions, lock as lockmod, vfs as vfsmod
 from mercurial.i18n import _
 
-sys.path.append(os.path.dirname(__file__))
-from deprecate import replace_deprecated, deprecated
+# The version of hg, which is looked up only once since this is run for every
+# hg command.
+hgversion = util.version()
 
-if util.version() >= b'4.2':
+if hgversion >= b'4.2':
     from mercurial import rcutil
     rcpath = rcutil.rccomponents
     userrcpath = rcutil.userrcpath
-elif util.version() >= b'1.9':
+elif hgversion >= b'1.9':
     from mercurial.scmutil import rcpath, userrcpath
 else:
     rcpath = util.rcpath
     userrcpath = util.userrcpath
 
-if util.version() >= b'4.7':
+if hgversion >= b'4.7':
     from mercurial.registrar import command
 else:
     from mercurial.cmdutil import command
@@ -86,12 +97,519 @@ def localrc(repo=None):
     return os.path.join(repo.path, b'hgrc')
 
 
-def getconfigs(ui, repo):
+class configfinder(object):
+    """
+    Looks for the config files hg reads, remembering what it found.
+
+    `rcpath()` is only called once, and each file is only looked up with
+    `os.stat` once. While a command is running, every caller uses the same
+    finder, see `getfinder`.
+
+    On network file systems, where each lookup can take a while, files can be
+    looked up and read ahead of time by a few threads at once, see `prefetch`.
+    """
+
+    def __init__(self):
+        self._components = None
+        self._userpaths = None
+        self._stats = {}
+        self._fstypes = {}
+        self._prefetched = {}
+        self._fetched = set()
+
+    def components(self):
+        """
+        Returns what `rcpath()` returns, as `(kind, obj)` pairs even for hg
+        before 4.2, which only returned paths.
+        """
+        if self._components is None:
+            components = rcpath()
+            if hgversion < b'4.2':
+                components = [(b'path', p) for p in components]
+            self._components = components
+        return self._components
+
+    def paths(self):
+        """
+        Returns the paths of the config files hg would read, other than the
+        repository's one.
+        """
+        return [obj for kind, obj in self.components() if kind == b'path']
+
+    def userpaths(self):
+        """
+        Returns the set of paths of the user's config files.
+        """
+        if self._userpaths is None:
+            self._userpaths = set(userrcpath())
+        return self._userpaths
+
+    def stat(self, path):
+        """
+        Returns the `os.stat` result for the given path, or `None` if it
+        can't be looked up (like `os.path.exists`).
+        """
+        try:
+            return self._stats[path]
+        except KeyError:
+            pass
+        countwork(b'stats')
+        with phase(b'stat'):
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+        self._stats[path] = st
+        return st
+
+    def fstype(self, path):
+        """
+        Returns the type of the file system the given file is on, as named by
+        `util.getfstype`, or `None` if it's not known.
+        """
+        d = os.path.dirname(path)
+        try:
+            return self._fstypes[d]
+        except KeyError:
+            pass
+        try:
+            fstype = util.getfstype(d)
+        except (AttributeError, OSError):
+            fstype = None
+        self._fstypes[d] = fstype
+        return fstype
+
+    def workers(self, ui, paths):
+        """
+        Returns how many threads to look up the given files with: up to
+        "hgcfg.io-workers" if any of them is on a network file system, where
+        each lookup waits on the network, and 1 otherwise.
+        """
+        workers = min(ui.configint(b'hgcfg', b'io-workers', 4), len(paths))
+        if workers <= 1:
+            return 1
+        if any(self.fstype(p) in _networkfs for p in paths):
+            return workers
+        return 1
+
+    def prefetch(self, ui, paths, read=False):
+        """
+        Looks up the given files with `os.stat`, and reads those which exist
+        if `read` is set, using as many threads as `workers` says, so that
+        `stat` and `readahead` don't wait for them one after another later.
+        Files which have already been looked up, or read, are skipped.
+        """
+        if read:
+            paths = [p for p in paths if p not in self._fetched]
+        else:
+            paths = [p for p in paths if p not in self._stats]
+        workers = self.workers(ui, paths)
+        if workers <= 1:
+            return
+
+        def fetch(path):
+            if path in self._stats:
+                st = self._stats[path]
+            else:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    st = None
+            if st is None:
+                return None, None
+            if not read:
+                return st, None
+            try:
+                with open(path, 'rb') as f:
+                    return st, (statsig(os.fstat(f.fileno())), f.read())
+            except IOError as inst:
+                return st, inst
+
+        with phase(b'parse' if read else b'stat'):
+            results = parallelmap(fetch, paths, workers)
+        for path, (st, data) in zip(paths, results):
+            if path not in self._stats:
+                countwork(b'stats')
+                self._stats[path] = st
+            if read:
+                self._fetched.add(path)
+                if data is not None:
+                    self._prefetched[path] = data
+
+    def readahead(self, path):
+        """
+        Returns what `prefetch` read from the given file, as a `(statsig,
+        data)` pair, or the `IOError` it got reading it, and forgets it. Returns
+        `None` if the file was not read ahead of time.
+        """
+        return self._prefetched.pop(path, None)
+
+    def forget(self, path):
+        """
+        Forgets what was found for the given file, after changing it.
+        """
+        self._stats.pop(path, None)
+        self._prefetched.pop(path, None)
+        self._fetched.discard(path)
+
+
+# The file system types, as named by `util.getfstype`, on which config files
+# are looked up and read by several threads at once.
+_networkfs = frozenset([
+    b'afs', b'ceph', b'cifs', b'coda', b'fuse', b'gfs2', b'ncpfs', b'nfs',
+    b'ocfs2', b'smb', b'smb2', b'v9fs',
+])
+
+
+def parallelmap(func, items, workers):
+    """
+    Returns `[func(item) for item in items]`, calling `func` from up to
+    `workers` threads at once. The results are in the order of `items`
+    whichever finishes first, and the first exception raised by `func`, in
+    that order, is raised again.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    pending = iter(range(len(items)))
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            with lock:
+                i = next(pending, None)
+            if i is None:
+                return
+            try:
+                results[i] = func(items[i])
+            except Exception as inst:
+                errors[i] = inst
+
+    threads = [threading.Thread(target=work)
+               for i in range(min(workers, len(items)) - 1)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    work()
+    for t in threads:
+        t.join()
+    for inst in errors:
+        if inst is not None:
+            raise inst
+    return results
+
+
+# The `configfinder` used by the running command, see `commandstate`.
+_finder = None
+
+
+def getfinder():
+    """
+    Returns the `configfinder` of the running command, or a new one if no
+    command is running, so that nothing is remembered between commands.
+    """
+    if _finder is not None:
+        return _finder
+    return configfinder()
+
+
+def commandstate(func):
+    """
+    Decorates a command to use a new `configfinder` while it runs, which is
+    shared by everything that looks for config files, and to profile it with
+    a new `phaseprofile` if asked to with --profile-phases or "hgcfg.trace".
+    """
+    @functools.wraps(func)
+    def wrapper(ui, *args, **kwargs):
+        global _finder, _profile
+        outer = _finder, _profile
+        _finder = configfinder()
+        _profile = None
+        if kwargs.get('profile_phases') or ui.configbool(b'hgcfg', b'trace'):  # Don't use bytestring
+            _profile = phaseprofile()
+        if _profile is None:
+            try:
+                return func(ui, *args, **kwargs)
+            finally:
+                _finder, _profile = outer
+
+        profile = _profile
+        wrapped = [(name, getattr(ui, name)) for name in profile.WRITERS]
+        for name, orig in wrapped:
+            setattr(ui, name, profile.counting(orig))
+        try:
+            return func(ui, *args, **kwargs)
+        finally:
+            for name, orig in wrapped:
+                delattr(ui, name)
+            _finder, _profile = outer
+            profile.stop()
+            profile.report(ui, pycompat.sysbytes(func.__name__))
+    return wrapper
+
+
+# The `phaseprofile` of the running command, if it is being profiled.
+_profile = None
+
+
+class phaseprofile(object):
+    """
+    Collects how long each phase of a command takes, and counts the work done
+    in them, for --profile-phases. A phase is entered with `phase`, or by
+    calling a function decorated with `inphase`; time spent in a phase entered
+    from within another counts for the inner one only, and time spent outside
+    of all of them is reported as 'other'.
+    """
+    PHASES = (b'discover', b'stat', b'parse', b'resolve', b'render')
+    COUNTERS = (
+        (b'stats', b"files stat'd"),
+        (b'bytes', b'bytes read'),
+        (b'lines', b'lines scanned'),
+        (b'writes', b'ui.write calls'),
+    )
+
+    # The `ui` methods whose calls are counted as writes, and timed as
+    # rendering.
+    WRITERS = ('write', 'status', 'note', 'warn')  # Don't use bytestring
+
+    def __init__(self):
+        self.times = dict.fromkeys(self.PHASES, 0.0)
+        self.calls = dict.fromkeys(self.PHASES, 0)
+        self.counters = dict.fromkeys((c for c, d in self.COUNTERS), 0)
+        self.total = None
+        self._start = util.timer()
+        self._stack = []
+
+    def enter(self, name):
+        now = util.timer()
+        if self._stack:
+            outer = self._stack[-1]
+            self.times[outer[0]] += now - outer[1]
+        self._stack.append([name, now])
+        self.calls[name] += 1
+
+    def leave(self):
+        now = util.timer()
+        name, since = self._stack.pop()
+        self.times[name] += now - since
+        if self._stack:
+            self._stack[-1][1] = now
+
+    def counting(self, func):
+        """
+        Wraps a `ui` output method to count and time its calls.
+        """
+        def write(*args, **kwargs):
+            self.counters[b'writes'] += 1
+            self.enter(b'render')
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.leave()
+        return write
+
+    def stop(self):
+        self.total = util.timer() - self._start
+
+    def data(self, command):
+        """
+        Returns the report as a JSON-serializable dict, with times in seconds.
+        """
+        phases = {}
+        for p in self.PHASES:
+            phases[pycompat.sysstr(p)] = {'time': self.times[p],  # Don't use bytestring
+                                          'calls': self.calls[p]}  # Don't use bytestring
+        phases['other'] = {  # Don't use bytestring
+            'time': max(0.0, self.total - sum(self.times.values())),  # Don't use bytestring
+            'calls': 1}  # Don't use bytestring
+        return {
+            'command': pycompat.sysstr(command),  # Don't use bytestring
+            'time': time.time(),  # Don't use bytestring
+            'total': self.total,  # Don't use bytestring
+            'phases': phases,  # Don't use bytestring
+            'counters': dict((pycompat.sysstr(c), self.counters[c])  # Don't use bytestring
+                             for c, d in self.COUNTERS),
+        }
+
+    def report(self, ui, command):
+        """
+        Writes the report to stderr, and appends it as a line of JSON to the
+        file named by "hgcfg.trace-json", if any.
+        """
+        data = self.data(command)
+        ui.write_err(_(b'hgcfg %s phases:\n') % command)
+        for p in self.PHASES + (b'other',):
+            d = data['phases'][pycompat.sysstr(p)]  # Don't use bytestring
+            ui.write_err(b'  %-10s %10.3f ms %6d\n'
+                         % (p, d['time'] * 1000, d['calls']))  # Don't use bytestring
+        ui.write_err(b'  %-10s %10.3f ms\n' % (_(b'total'), self.total * 1000))
+        ui.write_err(_(b'hgcfg %s counters:\n') % command)
+        for c, desc in self.COUNTERS:
+            ui.write_err(b'  %-16s %10d\n' % (_(desc), self.counters[c]))
+
+        path = ui.config(b'hgcfg', b'trace-json')
+        if path:
+            import json
+            with open(util.expandpath(path), 'ab') as f:
+                f.write(pycompat.sysbytes(json.dumps(data, sort_keys=True)) + b'\n')
+
+
+class _nophase(object):
+    """
+    Stands in for a phase when no command is being profiled.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_nophase = _nophase()
+
+
+class _phase(object):
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.profile.enter(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.leave()
+        return False
+
+
+def phase(name):
+    """
+    Returns a context manager which times what runs in it as the named phase
+    of the running command, if it is being profiled.
+    """
+    if _profile is None:
+        return _nophase
+    return _phase(_profile, name)
+
+
+def inphase(name):
+    """
+    Decorates a function to time its calls as the named phase of the running
+    command, if it is being profiled.
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profile = _profile
+            if profile is None:
+                return func(*args, **kwargs)
+            profile.enter(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.leave()
+        return wrapper
+    return decorate
+
+
+def countwork(name, n=1):
+    """
+    Adds to the named counter of the running command, if it is being
+    profiled.
+    """
+    if _profile is not None:
+        _profile.counters[name] += n
+
+
+class configfile(object):
+    """
+    A config file, as returned by `getconfigs`. Its fields can be read as
+    attributes, or like the keys of the dictionary this used to be, as in
+    `c[b'scope']`. Many of these are kept at once when going through a lot of
+    repositories, so it only has room for its fields.
+
+    Whether the file is writeable is only looked up with `os.access` if it
+    isn't given, and the first time it is asked for, since only the commands
+    which write to config files need to know.
+    """
+    __slots__ = ('scope', 'path', 'exists', '_writeable')  # Don't use bytestring
+
+    _fields = {
+        b'scope': 'scope',  # Don't use bytestring
+        b'path': 'path',  # Don't use bytestring
+        b'exists': 'exists',  # Don't use bytestring
+        b'writeable': 'writeable',  # Don't use bytestring
+    }
+
+    def __init__(self, scope, path, exists=True, writeable=False):
+        self.scope = scope
+        self.path = path
+        self.exists = exists
+        self._writeable = writeable
+
+    @property
+    def writeable(self):
+        if self._writeable is None:
+            self._writeable = self.exists and os.access(self.path, os.W_OK)
+        return self._writeable
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, self._fields[key])
+        except KeyError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key in self._fields:
+            return getattr(self, self._fields[key])
+        return default
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def keys(self):
+        return list(self._fields)
+
+    def __repr__(self):
+        return '<configfile %s %s>' % (  # Don't use bytestring
+            pycompat.sysstr(self.scope), pycompat.sysstr(self.path))
+
+
+# Interned names and values, see `intern`.
+_interned = {}
+
+# How many of them to keep at most, since a long-running process may see any
+# number of different ones. Going over only means that new ones are not shared
+# with those seen before.
+_INTERNLIMIT = 1 << 16
+
+
+def intern(s):
+    """
+    Returns a string equal to `s`, which is the same object for every equal
+    string passed in, so that section and key names, paths and values which
+    are found in many config files are only kept in memory once. Like
+    `sys.intern`, but for `bytes`.
+    """
+    try:
+        return _interned[s]
+    except KeyError:
+        pass
+    if len(_interned) >= _INTERNLIMIT:
+        _interned.clear()
+    _interned[s] = s
+    return s
+
+
+@inphase(b'discover')
+def getconfigs(ui, repo, prefetch=False):
     """
     Get a sequence of possible configuration files, including local
     (repository), user, and global.
 
-    Each item in the returned sequence is a dictionary with the following keys:
+    Each item in the returned sequence is a `configfile`, with the following
+    fields:
 
     `scope`
         One of 'local', 'user', or 'global'.
@@ -107,22 +625,24 @@ def getconfigs(ui, repo):
         A `bool` indicating whether or not the file is writeable by the
         current user.
 
+    On network file systems, the files are looked up by several threads at
+    once, and read ahead of time as well if `prefetch` is set, for callers
+    which are going to parse all of them (see `configfinder.prefetch`).
+    Files which are in the `warmcache` are not read ahead, and neither are
+    any when the `parsecache` is on.
     """
-    allconfigs = rcpath()
-    # From 4.2 rcpath(rcutil.rccomponents) returns a tuple
-    # Not checking here on isinstance, If return type changes, this will probably break instead of silently ignoring
-    # this and treating the output as a string like before 4.2.
-    if util.version() >= b'4.2':
-        allconfigs = [c[1] for c in allconfigs if c[0] == b'path']
+    finder = getfinder()
+    allconfigs = finder.paths()
     local_config = localrc(repo)
     if local_config is not None:
-        # rcpath() returns a reference to a global list, must not modify
-        # it in place by "+=" but instead create a copy by "+".
+        # The finder's list is shared, must not modify it in place by "+="
+        # but instead create a copy by "+".
         allconfigs = allconfigs + [local_config]
-    userconfigs = set(userrcpath())
+    userconfigs = finder.userpaths()
 
     configs = []
     paths = set()
+    finder.prefetch(ui, allconfigs)
 
     # for all global configs
     for f in allconfigs:
@@ -136,26 +656,1225 @@ def getconfigs(ui, repo):
             scope = b'user'
         else:
             scope = b'global'
-        if not os.path.exists(f):
-            exists = False
-            writeable = False
+        exists = finder.stat(f) is not None
+        configs.append(configfile(scope, intern(f), exists, None))
+
+    # Files which the caches have don't need to be read at all. The parse
+    # cache can only tell by reading its own files, so read-ahead is left to
+    # it when it is on.
+    if prefetch and getparsecache(ui) is None:
+        warm = getwarmcache(ui)
+        finder.prefetch(ui, [c[b'path'] for c in configs if c[b'exists'] and
+                             (warm is None or warm.node(c[b'path']) is None)],
+                        read=True)
+    return configs
+
+
+# A single value assigned to a key, along with where it was assigned: the file
+# and (1-based) line number of the assignment, and the scope of the config file
+# it was read through. Like `configfile`, it has no room for anything else.
+configentry = collections.namedtuple('configentry', 'value path line scope')
+
+# The keys of each section of a `parsedconfig`, which must keep the order in
+# which they were (last) assigned. Plain dictionaries do, and take much less
+# memory than a `util.sortdict`, but only since Python 3.7.
+if sys.version_info >= (3, 7):
+    _sectiondict = dict
+else:
+    _sectiondict = util.sortdict
+
+
+class lazyre(object):
+    """
+    A regular expression which is compiled when it is first used, rather than
+    when the extension is loaded, which happens for every hg command.
+    """
+
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+
+    def __getattr__(self, name):
+        value = getattr(re.compile(self.pattern, self.flags), name)
+        setattr(self, name, value)
+        return value
+
+
+# The grammar of hg config files, as used by `mercurial.config.config.parse`.
+_sectionre = lazyre(br'\[([^\[]+)\]')
+_itemre = lazyre(br'([^=\s][^=]*?)\s*=\s*(.*\S|)')
+_contre = lazyre(br'\s+(\S|\S.*\S)\s*$')
+_emptyre = lazyre(br'(;|#|\s*$)')
+_commentre = lazyre(br'(;|#)')
+_unsetre = lazyre(br'%unset\s+(\S+)')
+_includere = lazyre(br'%include\s+(\S|\S.*\S)\s*$')
+
+
+class configfilenode(object):
+    """
+    A single config file parsed on its own, without following the files it
+    `%include`s, as a list of `events` in the order they appear in the file:
+
+    `(b'section', section)`
+        A section header.
+
+    `(b'set', section, key, value, line)`
+        An assignment, with any continuation lines already joined to the
+        value.
+
+    `(b'unset', section, key, line)`
+        An `%unset` of a key.
+
+    `(b'include', path, line)`
+        An `%include` of another file, with its path already resolved.
+
+    `sig` is the `statsig` of the file when it was read.
+    """
+
+    def __init__(self, path, sig, events):
+        self.path = path
+        self.sig = sig
+        self.events = events
+
+    def getstate(self):
+        """
+        Returns the node as plain tuples and lists, suitable for `marshal`.
+        """
+        return (self.path, self.sig, self.events)
+
+
+def parseconfigfile(path):
+    """
+    Reads and parses a single config file into a `configfilenode`, in a
+    single pass, following the grammar used by `mercurial.config.config`.
+    Raises `IOError` if the file cannot be read, and `error.ConfigError` if it
+    cannot be parsed. What `configfinder.prefetch` read from it is used, if
+    anything.
+    """
+    fetched = getfinder().readahead(path)
+    if isinstance(fetched, EnvironmentError):
+        raise fetched
+    if fetched is not None:
+        sig, data = fetched
+    else:
+        with open(path, 'rb') as f:
+            sig = statsig(os.fstat(f.fileno()))
+            data = f.read()
+    countwork(b'bytes', len(data))
+    return parseconfigdata(path, data, sig)
+
+
+def parseconfigdata(path, data, sig=None):
+    """
+    Like `parseconfigfile`, but parses the given contents of the file.
+    """
+    return parseconfiglines(path, data.splitlines(True), sig)
+
+
+def parseconfiglines(path, lines, sig=None, keys=None):
+    """
+    Like `parseconfigdata`, but parses the lines of the file from the given
+    iterable, split like `bytes.splitlines(True)` does. If a set of
+    `(section, key)` pairs is given as `keys`, only the assignments and
+    `%unset`s of those keys are kept.
+    """
+    events = []
+    section = b''
+    cont = keep = False
+    line = 0
+    for line, l in enumerate(lines, 1):
+        if line == 1 and l.startswith(b'\xef\xbb\xbf'):
+            l = l[3:]
+        if cont:
+            if _commentre.match(l):
+                continue
+            m = _contre.match(l)
+            if m:
+                if keep:
+                    e = events[-1]
+                    events[-1] = e[:3] + (e[3] + b'\n' + m.group(1),) + e[4:]
+                continue
+            cont = False
+        m = _includere.match(l)
+        if m:
+            inc = util.expandpath(m.group(1))
+            inc = os.path.normpath(os.path.join(os.path.dirname(path), inc))
+            events.append((b'include', inc, line))
+            continue
+        if _emptyre.match(l):
+            continue
+        m = _sectionre.match(l)
+        if m:
+            section = m.group(1)
+            events.append((b'section', section))
+            continue
+        m = _itemre.match(l)
+        if m:
+            cont = True
+            keep = keys is None or (section, m.group(1)) in keys
+            if keep:
+                events.append((b'set', section, m.group(1), m.group(2), line))
+            continue
+        m = _unsetre.match(l)
+        if m:
+            if keys is None or (section, m.group(1)) in keys:
+                events.append((b'unset', section, m.group(1), line))
+            continue
+
+        message = l.rstrip()
+        if l.startswith(b' '):
+            message = b"unexpected leading whitespace: %s" % message
+        raise error.ConfigError(message, b"%s:%d" % (path, line))
+
+    countwork(b'lines', line)
+    return configfilenode(path, sig, events)
+
+
+class includegraph(object):
+    """
+    The config files read while handling a command, and the files they
+    `%include`. Each file is parsed at most once (or taken from the given
+    `warmcache` or loaded from the given `parsecache`, if any), however many
+    other files include it.
+    """
+
+    def __init__(self, cache=None, warm=None):
+        self.cache = cache
+        self.warm = warm
+        self._nodes = {}
+
+    def node(self, path):
+        """
+        Returns the `configfilenode` for the given file. Raises `IOError` if
+        it cannot be read.
+        """
+        node = self._nodes.get(path)
+        if node is None:
+            if self.warm is not None:
+                node = self.warm.node(path)
+            if node is None and self.cache is not None:
+                node = self.cache.load(path)
+            if node is None:
+                node = parseconfigfile(path)
+                if self.cache is not None:
+                    self.cache.store(node)
+            if self.warm is not None:
+                self.warm.storenode(node)
+            self._nodes[path] = node
+        return node
+
+    def resource(self, name):
+        """
+        Adds the config file that hg bundles as the given `(package, name)`
+        resource, and returns the path to use for it (which is not a real
+        file system path).
+        """
+        path = b'resource:%s.%s' % name
+        if path not in self._nodes:
+            from mercurial.utils import resourceutil
+            with resourceutil.open_resource(name[0], name[1]) as fp:
+                data = fp.read()
+            countwork(b'bytes', len(data))
+            self._nodes[path] = parseconfigdata(path, data)
+        return path
+
+
+class parsedconfig(object):
+    """
+    The contents of a config file, including the files it `%include`s, as
+    `mercurial.config.config` would read it.
+
+    `data` maps each section name to an ordered dictionary holding the active
+    `configentry` for each key in it.
+
+    `assignments` maps each `(section, key)` pair which was assigned more than
+    once since it was last `%unset` to a list of every `configentry` assigned
+    to it, in the order they were read. The last one is the active one. Keys
+    which were assigned once, which is most of them, only have their entry in
+    `data` (see `values`).
+
+    Section and key names and values are `intern`ed, so that those repeated
+    across many config files are only kept in memory once.
+
+    `unset` is the set of `(section, key)` pairs that were `%unset`, which
+    also removes any value they got from config files read before this one.
+
+    `deps` lists a `(path, statsig)` pair for every file that was read, or
+    that was included but did not exist (with a `statsig` of `None`).
+
+    The files are taken from the given `includegraph`, or read from disk if
+    there is none.
+    """
+
+    def __init__(self, path, scope=None, graph=None):
+        self.path = path
+        self.scope = scope
+        self.data = {}
+        self.assignments = {}
+        self.unset = set()
+        self.deps = []
+        self._digest = None
+        self._sorted = {}
+        if graph is None:
+            graph = includegraph()
+        with phase(b'parse'):
+            self._compose(graph, path, ())
+
+    def sortedsections(self):
+        """
+        Returns the sorted list of section names, for `globrange`.
+        """
+        names = self._sorted.get(None)
+        if names is None:
+            names = self._sorted[None] = sorted(self.data)
+        return names
+
+    def sortedkeys(self, section):
+        """
+        Returns the sorted list of key names in the given section, for
+        `globrange`.
+        """
+        names = self._sorted.get(section)
+        if names is None:
+            names = self._sorted[section] = sorted(self.data.get(section, ()))
+        return names
+
+    def digest(self):
+        """
+        Returns a hex digest of what the file sets and `%unset`s, which stays
+        the same if only comments, formatting or the order of values change.
+        It is computed once, and kept along with the rest of the parsed file.
+        """
+        if self._digest is None:
+            h = hashlib.sha1()
+            entries = ((s, k, e.value) for s, items in self.data.items()
+                       for k, e in items.items())
+            for fields in sorted(entries):
+                for field in fields:
+                    h.update(b'%d:%s' % (len(field), field))
+            h.update(b'-')
+            for fields in sorted(self.unset):
+                for field in fields:
+                    h.update(b'%d:%s' % (len(field), field))
+            self._digest = pycompat.sysbytes(h.hexdigest())
+        return self._digest
+
+    def values(self, section, key):
+        """
+        Returns every `configentry` in effect for the key, in the order they
+        were read, so the last one is the active one.
+        """
+        entries = self.assignments.get((section, key))
+        if entries is not None:
+            return list(entries)
+        e = self.data.get(section, {}).get(key)
+        if e is None:
+            return []
+        return [e]
+
+    def _compose(self, graph, path, stack):
+        try:
+            node = graph.node(path)
+        except IOError as inst:
+            if inst.errno == errno.ENOENT:
+                self.deps.append((path, None))
+            raise
+        self.deps.append((path, node.sig))
+        stack = stack + (path,)
+
+        scope = self.scope
+        data = self.data
+        assignments = self.assignments
+        path = intern(path)
+        for ev in node.events:
+            kind = ev[0]
+            if kind == b'set':
+                section, key = intern(ev[1]), intern(ev[2])
+                e = configentry(intern(ev[3]), path, ev[4], scope)
+                items = data.get(section)
+                if items is None:
+                    items = data[section] = _sectiondict()
+                old = items.pop(key, None)
+                items[key] = e
+                if old is not None:
+                    entries = assignments.get((section, key))
+                    if entries is None:
+                        assignments[(section, key)] = [old, e]
+                    else:
+                        entries.append(e)
+            elif kind == b'section':
+                section = intern(ev[1])
+                if section not in data:
+                    data[section] = _sectiondict()
+            elif kind == b'unset':
+                section, key = ev[1], ev[2]
+                data.get(section, {}).pop(key, None)
+                assignments.pop((section, key), None)
+                self.unset.add((section, key))
+            elif kind == b'include':
+                inc = ev[1]
+                if inc in stack:
+                    continue
+                try:
+                    self._compose(graph, inc, stack)
+                except IOError as inst:
+                    if inst.errno != errno.ENOENT:
+                        raise error.ConfigError(
+                            _(b"cannot include %s (%s)")
+                            % (inc, encoding.strtolocal(inst.strerror)),
+                            b"%s:%d" % (path, ev[2]))
+
+
+def statsig(st):
+    """
+    Returns the part of a `stat` result that is used to tell whether a file
+    has changed: its modification time, size and inode number.
+    """
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+
+def filesig(path):
+    """
+    Returns the `statsig` of the given file, or `None` if it does not exist.
+    """
+    st = getfinder().stat(path)
+    if st is None:
+        return None
+    return statsig(st)
+
+
+class parsecache(object):
+    """
+    A persistent, on-disk cache of `configfilenode` results, with one cache
+    file per config file. A cached result is only used if the file has not
+    changed since it was parsed, according to `statsig`.
+    """
+
+    # Bump this whenever the format of `configfilenode.getstate` changes.
+    FORMAT = 2
+
+    # Files modified less than this many seconds before they were parsed
+    # are not cached, because a later change might not alter their mtime.
+    AMBIGUOUS = 2
+
+    def __init__(self, ui, path):
+        self.ui = ui
+        self.path = path
+
+    def _entrypath(self, rcfile):
+        name = pycompat.sysbytes(hashlib.sha1(rcfile).hexdigest())
+        return os.path.join(self.path, name)
+
+    def _header(self):
+        return (self.FORMAT, tuple(sys.version_info[:2]))
+
+    def _loadstate(self, entrypath):
+        try:
+            with open(entrypath, 'rb') as f:
+                header, state = marshal.load(f)
+                countwork(b'bytes', f.tell())
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if header != self._header():
+            return None
+        return state
+
+    def _fresh(self, state):
+        return filesig(state[0]) == state[1]
+
+    def load(self, rcfile):
+        """
+        Returns the cached `configfilenode` for the given file, or `None` if
+        there is no valid entry for it.
+        """
+        state = self._loadstate(self._entrypath(rcfile))
+        if state is None or state[0] != rcfile or not self._fresh(state):
+            self.ui.debug(b'hgcfg: parse cache miss for %s\n' % rcfile)
+            return None
+        self.ui.debug(b'hgcfg: parse cache hit for %s\n' % rcfile)
+        return configfilenode(*state)
+
+    def store(self, node):
+        """
+        Stores the given `configfilenode`, unless the file was modified too
+        recently to tell later changes apart.
+        """
+        if time.time() - node.sig[0] < self.AMBIGUOUS:
+            return False
+        try:
+            util.makedirs(self.path)
+            with util.atomictempfile(self._entrypath(node.path), b'wb') as f:
+                f.write(marshal.dumps((self._header(), node.getstate())))
+        except (IOError, OSError) as inst:
+            self.ui.debug(b'hgcfg: could not write parse cache: %s\n'
+                          % encoding.strtolocal(str(inst)))
+            return False
+        return True
+
+    def entries(self):
+        """
+        Returns the paths of all entries in the cache.
+        """
+        try:
+            names = os.listdir(self.path)
+        except OSError as inst:
+            if inst.errno != errno.ENOENT:
+                raise
+            return []
+        return [os.path.join(self.path, n) for n in sorted(names)]
+
+    def stats(self):
+        """
+        Returns a dictionary describing the contents of the cache: the
+        number of `entries`, how many of them are `fresh` and `stale`, and
+        their total size in `bytes`.
+        """
+        stats = {b'entries': 0, b'fresh': 0, b'stale': 0, b'bytes': 0}
+        for entrypath in self.entries():
+            stats[b'entries'] += 1
+            stats[b'bytes'] += os.path.getsize(entrypath)
+            state = self._loadstate(entrypath)
+            if state is not None and self._fresh(state):
+                stats[b'fresh'] += 1
+            else:
+                stats[b'stale'] += 1
+        return stats
+
+    def clear(self):
+        """
+        Removes every entry from the cache and returns how many there were.
+        """
+        entries = self.entries()
+        for entrypath in entries:
+            util.tryunlink(entrypath)
+        return len(entries)
+
+
+def parsecachedir(ui):
+    """
+    Returns the directory holding the parse cache: `hgcfg.cache-dir` if it is
+    set, otherwise an `hgcfg` directory under the platform's user cache
+    directory.
+    """
+    path = ui.config(b'hgcfg', b'cache-dir')
+    if path:
+        return util.expandpath(path)
+    if pycompat.iswindows:
+        base = encoding.environ.get(b'LOCALAPPDATA')
+    else:
+        base = encoding.environ.get(b'XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join(os.path.expanduser(b'~'), b'.cache')
+    return os.path.join(base, b'hgcfg')
+
+
+def getparsecache(ui, force=False):
+    """
+    Returns the `parsecache` to use, or `None` if caching parsed config files
+    has not been enabled with `hgcfg.cache` (and `force` is False).
+    """
+    if not force and not ui.configbool(b'hgcfg', b'cache', False):
+        return None
+    return parsecache(ui, parsecachedir(ui))
+
+
+class warmcache(object):
+    """
+    Parsed config files kept in memory from one command to the next, for
+    processes that run many commands, like the command server. Under chg,
+    whose workers exit after a single command, it is filled by the server
+    instead, see `prewarm`.
+
+    Both `configfilenode`s and `parsedconfig`s are kept, at most `size` of
+    each, dropping the least recently used ones. They are only used while
+    none of the files they were read from have changed, judging by
+    `filesig`. Like with the `parsecache`, files modified too recently to
+    tell later changes apart are not kept.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self._nodes = util.lrucachedict(size)
+        self._parsed = util.lrucachedict(size)
+
+    def resize(self, size):
+        with self._lock:
+            if size != self.size:
+                self.size = size
+                self._nodes = self._nodes.copy(size)
+                self._parsed = self._parsed.copy(size)
+
+    def _settled(self, sig):
+        return sig is None or time.time() - sig[0] >= parsecache.AMBIGUOUS
+
+    def node(self, path):
+        """
+        Returns the `configfilenode` kept for the given file, or `None`.
+        """
+        with self._lock:
+            node = self._nodes.get(path)
+        if node is None or filesig(path) != node.sig:
+            return None
+        return node
+
+    def storenode(self, node):
+        if self._settled(node.sig):
+            with self._lock:
+                self._nodes[node.path] = node
+
+    def parsed(self, path, scope):
+        """
+        Returns the `parsedconfig` kept for the given file and scope, or
+        `None`.
+        """
+        with self._lock:
+            p = self._parsed.get((path, scope))
+        if p is None:
+            return None
+        for dep, sig in p.deps:
+            if filesig(dep) != sig:
+                return None
+        return p
+
+    def storeparsed(self, p):
+        if all(self._settled(sig) for dep, sig in p.deps):
+            with self._lock:
+                self._parsed[(p.path, p.scope)] = p
+
+    def clear(self):
+        with self._lock:
+            self._nodes.clear()
+            self._parsed.clear()
+
+
+# The `warmcache` of this process, see `getwarmcache`.
+_warmcache = None
+
+
+def getwarmcache(ui):
+    """
+    Returns the `warmcache` of this process, holding as many files as
+    `hgcfg.warm-cache-size` says, or `None` if that is 0.
+    """
+    global _warmcache
+    size = ui.configint(b'hgcfg', b'warm-cache-size', 256)
+    if size <= 0:
+        return None
+    if _warmcache is None:
+        _warmcache = warmcache(size)
+    else:
+        _warmcache.resize(size)
+    return _warmcache
+
+
+def prewarm(ui):
+    """
+    Parses the global and user config files into the `warmcache`, if it's on,
+    so that processes forked from this one start with them. chg runs each
+    command in a worker forked from its server, which exits once the command
+    is done, so its cache is only ever warmed this way.
+
+    Files which can't be parsed are left out, for the command reading them to
+    report.
+    """
+    warm = getwarmcache(ui)
+    if warm is None:
+        return
+    configs = getconfigs(ui, None)
+    index = configindex(configs, warm=warm)
+    for c in configs:
+        if not c[b'exists']:
+            continue
+        try:
+            index.parsed(c)
+        except (error.Abort, error.ParseError, EnvironmentError):
+            pass
+
+
+class configindex(object):
+    """
+    An index over config files like those returned by `getconfigs`. Each
+    file is parsed at most once, the first time it is queried, and every
+    query after that is answered from the parsed result.
+
+    Files included by several configs are shared through an `includegraph`.
+    If a `warmcache` or a `parsecache` is given, parsed files are looked up
+    in it before parsing them, and stored in it after.
+    """
+
+    def __init__(self, configs, cache=None, warm=None):
+        self.configs = configs
+        self.graph = includegraph(cache, warm)
+        self.warm = warm
+        self._parsed = {}
+
+    def parsed(self, config):
+        """
+        Returns the `parsedconfig` for the given config.
+        """
+        path = config[b'path']
+        p = self._parsed.get(path)
+        if p is None:
+            if self.warm is not None:
+                p = self.warm.parsed(path, config[b'scope'])
+            if p is None:
+                p = parsedconfig(path, config[b'scope'], self.graph)
+                if self.warm is not None:
+                    self.warm.storeparsed(p)
+            self._parsed[path] = p
+        return p
+
+    def sections(self, config):
+        """
+        Returns the sorted names of all sections in the given config.
+        """
+        return self.parsed(config).sortedsections()
+
+    def items(self, config, section):
+        """
+        Returns the active `(key, value)` pairs of a section in the given
+        config, like `mercurial.config.config.items`.
+        """
+        items = self.parsed(config).data.get(section, {})
+        return [(k, e.value) for k, e in items.items()]
+
+    def entries(self, config, section):
+        """
+        Like `items`, but returns `(key, configentry)` pairs.
+        """
+        return list(self.parsed(config).data.get(section, {}).items())
+
+    def values(self, config, section, key):
+        """
+        Returns every `configentry` in effect for the key in the given config
+        (see `parsedconfig.values`).
+        """
+        return self.parsed(config).values(section, key)
+
+    def match(self, config, section, key=None):
+        """
+        Returns the `(section, key, configentry)` triples of the given config
+        whose section and key names match the given glob patterns (see
+        `globrange`), in sorted order. Without a key pattern, returns
+        `(section, None, None)` for each matching section instead.
+        """
+        p = self.parsed(config)
+        matches = []
+        for s in globrange(p.sortedsections(), section):
+            if key is None:
+                matches.append((s, None, None))
+                continue
+            items = p.data[s]
+            matches.extend((s, k, items[k])
+                           for k in globrange(p.sortedkeys(s), key))
+        return matches
+
+    def lookup(self, section, key):
+        """
+        Returns every `configentry` assigned to the key across all of the
+        indexed configs, in the order the configs were given.
+        """
+        entries = []
+        for c in self.configs:
+            entries.extend(self.values(c, section, key))
+        return entries
+
+
+def isglob(pattern):
+    """
+    Tells whether the given section or key name is a glob pattern, with '*'
+    matching any number of characters and '?' matching a single one.
+    """
+    return pattern is not None and (b'*' in pattern or b'?' in pattern)
+
+
+def globrange(names, pattern):
+    """
+    Generates the names in the given sorted list that match the glob
+    pattern. Only the range of names starting with the part of the pattern
+    before its first wildcard is looked at, which is found by bisection.
+    """
+    prefix = re.match(br'[^*?]*', pattern).group(0)
+    i = bisect.bisect_left(names, prefix)
+    if prefix == pattern:
+        if i < len(names) and names[i] == prefix:
+            yield prefix
+        return
+
+    if pattern == prefix + b'*':
+        regex = None
+    else:
+        regex = re.compile(b''.join(
+            b'.*' if c == b'*' else b'.' if c == b'?' else re.escape(c)
+            for c in pycompat.iterbytestr(pattern)) + br'\Z', re.S)
+    for name in itertools.islice(names, i, None):
+        if not name.startswith(prefix):
+            break
+        if regex is None or regex.match(name):
+            yield name
+
+
+def rclayers(ui, repo, prefetch=True):
+    """
+    Returns the layers that hg reads its configuration from, in order, so
+    that values from later layers take precedence. Each layer is a pair of:
+
+    `(b'path', config)`
+        A config file which exists, as returned by `getconfigs`.
+
+    `(b'items', items)`
+        Values taken from environment variables, as a list of
+        `(section, key, value, source)` tuples.
+
+    `(b'resource', name)`
+        A config file bundled with hg, as a `(package, name)` pair.
+
+    Values given with --config, which take precedence over all of these, are
+    not included. Config files are read ahead if `prefetch` is set, like with
+    `getconfigs`.
+    """
+    configs = dict((c[b'path'], c) for c in getconfigs(ui, repo, prefetch))
+    components = getfinder().components()
+    local_config = localrc(repo)
+    if local_config is not None:
+        components = components + [(b'path', local_config)]
+
+    layers = []
+    for kind, obj in components:
+        if kind == b'path':
+            c = configs.get(obj)
+            if c is None or not c[b'exists']:
+                continue
+            obj = c
+        layers.append((kind, obj))
+    return layers
+
+
+def iterlayers(ui, repo, index, scopes=None):
+    """
+    Generates the layers returned by `rclayers`, with the config files
+    parsed by the given `configindex`: as `(b'parsed', parsedconfig)` pairs
+    for config files (including those bundled with hg), and as they are for
+    values from environment variables. If `scopes` is given, only the config
+    files within those scopes are generated.
+    """
+    for kind, obj in rclayers(ui, repo):
+        if scopes is not None:
+            if kind != b'path' or obj[b'scope'] not in scopes:
+                continue
+        if kind == b'items':
+            yield kind, obj
+        elif kind == b'path':
+            yield b'parsed', index.parsed(obj)
+        elif kind == b'resource':
+            path = index.graph.resource(obj)
+            yield b'parsed', index.parsed(configfile(b'default', path))
+
+
+@inphase(b'resolve')
+def effectiveconfig(ui, repo, index=None, section=None, scopes=None):
+    """
+    Works out where hg gets the value of every key from, in a single pass
+    over the layers returned by `rclayers`, followed by the values given with
+    --config.
+
+    Returns a dictionary mapping each `(section, key)` pair to the winning
+    `configentry`. For values from environment variables, the path of the
+    entry names the variable and its scope is 'env'; for values given with
+    --config, the path is '--config' and the scope is 'override'; for the
+    config files bundled with hg, the scope is 'default'. Their line is
+    `None`.
+
+    If `section` is given, only keys in that section are included. If
+    `scopes` is given, only the config files within those scopes are taken
+    into account, without any of the other sources. Config files are parsed
+    with the given `configindex`, if any.
+    """
+    if index is None:
+        index = configindex([], warm=getwarmcache(ui))
+    effective = {}
+    for kind, obj in iterlayers(ui, repo, index, scopes):
+        if kind == b'items':
+            for s, k, v, source in obj:
+                if section is None or s == section:
+                    effective[(s, k)] = configentry(v, source, None, b'env')
+            continue
+        parsed = obj
+        for key in parsed.unset:
+            effective.pop(key, None)
+        for s, items in parsed.data.items():
+            if section is None or s == section:
+                for k, e in items.items():
+                    effective[(s, k)] = e
+
+    if scopes is not None:
+        return effective
+    for s, k, v in ui.walkconfig():
+        if section is not None and s != section:
+            continue
+        if ui.configsource(s, k) == b'--config':
+            effective[(s, k)] = configentry(v, b'--config', None, b'override')
+    return effective
+
+
+class activevalues(object):
+    """
+    Tells which values are active, like looking them up in what
+    `effectiveconfig` returns, but without parsing every layer up front. For
+    each value, only the layers after the config file it is assigned in are
+    looked at, one after another, until one of them sets or `%unset`s its key
+    again. Layers are parsed with the given `configindex`.
+    """
+
+    def __init__(self, ui, repo, index, prefetch=True):
+        self.ui = ui
+        self.index = index
+        self.layers = rclayers(ui, repo, prefetch)
+        self._positions = dict((obj[b'path'], i)
+                               for i, (kind, obj) in enumerate(self.layers)
+                               if kind == b'path')
+        self._items = {}
+
+    def _assigns(self, i, section, key):
+        """
+        Tells whether the `i`th layer sets or `%unset`s the given key.
+        """
+        kind, obj = self.layers[i]
+        if kind == b'items':
+            items = self._items.get(i)
+            if items is None:
+                items = self._items[i] = set((s, k) for s, k, v, source in obj)
+            return (section, key) in items
+        if kind == b'path':
+            parsed = self.index.parsed(obj)
+        else:
+            path = self.index.graph.resource(obj)
+            parsed = self.index.parsed(configfile(b'default', path))
+        return ((section, key) in parsed.unset or
+                key in parsed.data.get(section, ()))
+
+    def isactive(self, config, section, key):
+        """
+        Tells whether the last value the given config file assigns to the key
+        is the active one.
+        """
+        with phase(b'resolve'):
+            if self.ui.configsource(section, key) == b'--config':
+                return False
+            start = self._positions[config[b'path']] + 1
+            for i in range(start, len(self.layers)):
+                if self._assigns(i, section, key):
+                    return False
+            return True
+
+
+def showblame(ui, repo, section=None, **opts):
+    """
+    Writes out the effective value of every key (in the given section, if
+    any), along with where it comes from, for `cfg --blame`.
+    """
+    index = configindex([], getparsecache(ui), getwarmcache(ui))
+    effective = effectiveconfig(ui, repo, index, section)
+    out = outputbuffer(ui)
+    fm = getformatter(ui, out, b'cfg', opts)
+    for (s, k), e in sorted(effective.items()):
+        if fm is not None:
+            fm.startitem()
+            fm.data(scope=e.scope, path=e.path, line=e.line, section=s,
+                    key=k, value=e.value)
+            continue
+        if e.line is None:
+            source = e.path
+        else:
+            source = b'%s:%d' % (e.path, e.line)
+        out.write(source, label=b'hgcfg.file.' + e.scope)
+        out.write(b': ')
+        out.write(b'%s.%s' % (s, k), label=b'hgcfg.keyname')
+        out.write(b'=')
+        out.write(e.value, label=b'hgcfg.item.value.selected')
+        out.write(b'\n')
+    if fm is not None:
+        fm.end()
+    out.flush()
+
+
+def showgrep(ui, repo, regex, scopes, section=None, keys=True, values=True,
+             **opts):
+    """
+    Writes out every value in the config files within the given scopes (in
+    the given section, if any) whose `SECTION.KEY` name (if `keys`) or value
+    (if `values`) matches the given compiled regular expression, along with
+    where it was found, for `cfg --grep`. If a `limit` is given, no more
+    files are read once that many matches have been found.
+    """
+    configs = [c for c in getconfigs(ui, repo, prefetch=True) if c[b'scope'] in scopes and c[b'exists']]
+    index = configindex(configs, getparsecache(ui), getwarmcache(ui))
+    search = regex.search
+
+    def matches():
+        for c in configs:
+            data = index.parsed(c).data
+            if section is None:
+                sections = data.items()
+            elif section in data:
+                sections = [(section, data[section])]
+            else:
+                continue
+            for s, entries in sections:
+                for k, e in entries.items():
+                    name = b'%s.%s' % (s, k)
+                    if ((keys and search(name)) or
+                            (values and search(e.value))):
+                        yield s, k, e, name
+
+    out = outputbuffer(ui)
+    fm = getformatter(ui, out, b'cfg', opts)
+    for s, k, e, name in itertools.islice(matches(), opts.get('limit')):  # Don't use bytestring
+        if fm is not None:
+            fm.startitem()
+            fm.data(scope=e.scope, path=e.path, line=e.line,
+                    section=s, key=k, value=e.value)
+            continue
+        out.status(_(e.scope), label=b'hgcfg.scope.' + e.scope)
+        out.status(b' ')
+        out.status(b'%s:%d' % (e.path, e.line),
+                   label=b'hgcfg.file.' + e.scope)
+        out.status(b': ')
+        out.write(name, label=b'hgcfg.keyname')
+        out.write(b'=')
+        out.write(e.value, label=b'hgcfg.item.value')
+        out.write(b'\n')
+    if fm is not None:
+        fm.end()
+    out.flush()
+
+
+# A pair of scope sets to compare with --diff, like "local:user,global".
+_diffscopesre = lazyre(br'((?:local|user|global)(?:,(?:local|user|global))*)'
+                       br':((?:local|user|global)(?:,(?:local|user|global))*)$')
+
+
+def diffconfigs(ui, repo, other, section=None, **opts):
+    """
+    Writes out how the effective config of the given repository differs from
+    that of another one, or (if `other` is a pair of scope sets, like
+    "local:user,global") how the values set by the config files in the
+    first scopes differ from those set by the files in the second ones, for
+    `cfg --diff`.
+
+    Only keys whose value differs are shown, each with where its values come
+    from.
+    """
+    index = configindex([], getparsecache(ui), getwarmcache(ui))
+    m = _diffscopesre.match(other)
+    if m:
+        old = effectiveconfig(ui, repo, index, section,
+                              set(m.group(1).split(b',')))
+        new = effectiveconfig(ui, repo, index, section,
+                              set(m.group(2).split(b',')))
+    else:
+        otherrepo = hg.repository(ui, util.expandpath(other))
+        old = effectiveconfig(ui, repo, index, section)
+        new = effectiveconfig(ui, otherrepo, index, section)
+
+    out = outputbuffer(ui)
+    fm = getformatter(ui, out, b'cfg', opts)
+    for key in sorted(set(old) | set(new)):
+        o = old.get(key)
+        n = new.get(key)
+        if o is not None and n is not None and o.value == n.value:
+            continue
+        if o is None:
+            status = b'added'
+        elif n is None:
+            status = b'removed'
+        else:
+            status = b'changed'
+
+        if fm is not None:
+            fm.startitem()
+            fm.data(section=key[0], key=key[1], status=status)
+            if o is not None:
+                fm.data(oldvalue=o.value, oldpath=o.path, oldline=o.line,
+                        oldscope=o.scope)
+            if n is not None:
+                fm.data(newvalue=n.value, newpath=n.path, newline=n.line,
+                        newscope=n.scope)
+            continue
+
+        for mark, label, e in ((b'-', b'diff.deleted', o),
+                               (b'+', b'diff.inserted', n)):
+            if e is None:
+                continue
+            out.write(b'%s %s.%s=%s' % ((mark,) + key + (e.value,)),
+                      label=label)
+            if e.line is None:
+                source = e.path
+            else:
+                source = b'%s:%d' % (e.path, e.line)
+            out.status(b'  (')
+            out.status(source, label=b'hgcfg.file.' + e.scope)
+            out.status(b')')
+            out.write(b'\n')
+    if fm is not None:
+        fm.end()
+    out.flush()
+
+
+def showdigest(ui, repo, sections=None, scopes=None, allsources=False,
+               **opts):
+    """
+    Writes out a digest of what the config files (in the given scopes, if
+    any) set, for `cfg --digest`. It is combined from the digest of each
+    file, in the order hg reads them, which is kept along with the parsed
+    file (see `parsedconfig.digest`), so it doesn't depend on where they
+    are. If `sections` are given, it only depends on the effective keys and
+    values in those sections instead, not on where they come from.
+    With --verbose, the digest of each of the config files is written out
+    as well.
+
+    Values taken from environment variables, the config files bundled with
+    hg and values given with --config, which depend on where and how hg is
+    run rather than on its config files, are only covered if `allsources`
+    is set.
+    """
+    configs = [c for c in getconfigs(ui, repo, prefetch=True)
+               if c[b'exists'] and (scopes is None or c[b'scope'] in scopes)]
+    index = configindex(configs, getparsecache(ui), getwarmcache(ui))
+
+    h = hashlib.sha1()
+    if sections:
+        if allsources:
+            effective = effectiveconfig(ui, repo, index)
         else:
-            exists = True
-            if os.access(f, os.W_OK):
-                writeable = True
+            effective = effectiveconfig(ui, repo, index,
+                                        scopes=set(c[b'scope'] for c in configs))
+        for (s, k), e in sorted(effective.items()):
+            if s not in sections:
+                continue
+            for field in (s, k, e.value):
+                h.update(b'%d:%s' % (len(field), field))
+    else:
+        if allsources:
+            layers = iterlayers(ui, repo, index)
+        else:
+            layers = ((b'parsed', index.parsed(c)) for c in configs)
+        for kind, obj in layers:
+            if kind == b'items':
+                items = hashlib.sha1()
+                for fields in sorted(item[:3] for item in obj):
+                    for field in fields:
+                        items.update(b'%d:%s' % (len(field), field))
+                h.update(pycompat.sysbytes(items.hexdigest()))
             else:
-                writeable = False
-        configs.append({b'scope': scope, b'path': f, b'exists': exists,
-                        b'writeable': writeable})
+                h.update(obj.digest())
+        if allsources:
+            h.update(b'-')
+            for s, k, v in sorted(ui.walkconfig()):
+                if ui.configsource(s, k) == b'--config':
+                    for field in (s, k, v):
+                        h.update(b'%d:%s' % (len(field), field))
+    digest = pycompat.sysbytes(h.hexdigest())
+
+    out = outputbuffer(ui)
+    fm = getformatter(ui, out, b'cfg', opts)
+    if out.verbose:
+        for c in configs:
+            filedigest = index.parsed(c).digest()
+            if fm is not None:
+                fm.startitem()
+                fm.data(scope=c[b'scope'], path=c[b'path'], digest=filedigest)
+                continue
+            out.write(filedigest)
+            out.write(b' ')
+            out.write(_(c[b'scope']), label=b'hgcfg.scope.' + c[b'scope'])
+            out.write(b' ')
+            out.write(c[b'path'], label=b'hgcfg.file.' + c[b'scope'])
+            out.write(b'\n')
+    if fm is not None:
+        fm.startitem()
+        fm.data(digest=digest)
+        fm.end()
+    else:
+        out.write(digest + b'\n')
+    out.flush()
 
-    return configs
+
+def exportconfig(ui, repo, scopes, section=None):
+    """
+    Writes out a snapshot of the values set by the config files in the given
+    scopes (in the given section, if any), for `cfg --export`. Where a value
+    comes from is written in a comment before it. See `parsesnapshot`. Keys
+    which a snapshot has no room for, like those of sections with a '.' in
+    their name, are left out with a warning.
+    """
+    index = configindex([], getparsecache(ui), getwarmcache(ui))
+    effective = effectiveconfig(ui, repo, index, section, scopes)
+
+    out = outputbuffer(ui)
+    out.write(b'# hgcfg snapshot\n')
+    for scope in (b'global', b'user', b'local'):
+        entries = sorted((e.path, e.line, s, k, e.value)
+                         for (s, k), e in effective.items() if e.scope == scope)
+        if not entries:
+            continue
+        out.write(b'scope %s\n' % scope)
+        for path, line, s, k, v in entries:
+            if splitbatchkey(b'%s.%s' % (s, k)) != (s, k):
+                ui.warn(_(b"%s:%d: cannot export %s.%s, since it cannot be "
+                          b"imported back\n") % (path, line, s, k))
+                continue
+            out.write(b'# %s:%d\n' % (path, line))
+            out.write(b'set %s.%s %s\n' % (s, k, v.replace(b'\n', b'\n  ')))
+    out.flush()
+
+
+def importconfig(ui, repo, groups, scopes=None, choice=None):
+    """
+    Applies the operations of a snapshot, as returned by `parsesnapshot`,
+    each to a writeable config file in its scope (or in the given scopes,
+    if any), which is chosen like for `writevalue`. Every config file is
+    only rewritten once.
+    """
+    files = util.sortdict()
+    for scope, ops in groups:
+        if scopes:
+            targets = scopes
+        elif scope is not None:
+            targets = {scope}
+        else:
+            targets = {b'local'}
+        rcfile = choosewriteableconfig(ui, repo, targets,
+                                       _(b"which file do you want to write %s "
+                                         b"values to") % b'/'.join(sorted(targets)),
+                                       _(b"writing values to config [%d]\n"),
+                                       choice)
+        if rcfile is None:
+            return False
+        files.setdefault(rcfile, []).extend(ops)
+
+    for rcfile, ops in files.items():
+        if not writeopstofile(ui, repo, ops, rcfile):
+            return False
+        ui.note(_(b"applied %d operations to %s\n") % (len(ops), rcfile))
+    return True
+
+
+# Options for running a command across many repositories, see `fleet`.
+fleetopts = [
+    (b'', b'repos', b'',
+     b'run for each repository listed in FILE (- for stdin)', b'FILE'),
+    (b'j', b'jobs', 1,
+     b'number of repositories to process in parallel with --repos', b'N'),
+]
 
 
-@replace_deprecated("listconfigs")  # Don't use bytestring
 @command(b"listcfgs",
-         [],
-         b"",
+         fleetopts + cmdutil.formatteropts,
+         b"[options]",
          optionalrepo=True)
+@commandstate
 def listcfgs(ui, repo, **opts):
     """list all config files searched for and used by hg
 
@@ -163,10 +1882,42 @@ def listcfgs(ui, repo, **opts):
     order.  Each file name is preceeded by a status indicator: The status
     is '!' if the configuration file is missing. If the file is writable
     by the current user the status is 'rw', otherwise 'ro'.
+
+    With --repos, the config files of every repository listed in the given
+    file are listed instead, see 'hg help cfg'.
+
+    With -T/--template, each file is given to the template with its scope,
+    path, and whether it exists and is writeable. Use -T json for JSON
+    output.
     """
+    template = opts['template']  # Don't use bytestring
 
+    def run(ui, repo):
+        showconfigs(ui, repo, template=template)
+
+    if opts['repos']:  # Don't use bytestring
+        return fleet(ui, opts['repos'], opts['jobs'], run)  # Don't use bytestring
+    run(ui, repo)
+
+
+def showconfigs(ui, repo, **opts):
+    """
+    Writes the list of config files for `listcfgs`.
+    """
     configs = getconfigs(ui, repo)
 
+    out = outputbuffer(ui)
+    fm = getformatter(ui, out, b'listcfgs', opts)
+    if fm is not None:
+        for c in configs:
+            fm.startitem()
+            fm.data(scope=c[b'scope'], path=c[b'path'],
+                    exists=bool(c[b'exists']),
+                    writeable=bool(c[b'writeable']))
+        fm.end()
+        out.flush()
+        return
+
     for c in configs:
         label = b"hgcfg.file." + c[b'scope']
 
@@ -180,9 +1931,10 @@ def listcfgs(ui, repo, **opts):
             status_str = b'ro'
             label += b".readonly"
 
-        ui.status(_(b" %s %-6s " % (status_str, c[b'scope'])), label=label)
-        ui.write(c[b'path'], label=label)
-        ui.write(_(b"\n"))
+        out.status(_(b" %s %-6s " % (status_str, c[b'scope'])), label=label)
+        out.write(c[b'path'], label=label)
+        out.write(_(b"\n"))
+    out.flush()
 
 
 def showvalue(ui, repo, section, key, scopes, **opts):
@@ -190,80 +1942,141 @@ def showvalue(ui, repo, section, key, scopes, **opts):
     Shows values for specified configuration keys, or lists all
     keys and there values in the specified section, or lists all sections
     in the specified scope.
+
+    If a `limit` is given, at most that many sections or values are shown.
+    Except with --quiet, where they are sorted first, they are written out
+    as the config files are read, and files are only read as they are needed
+    (see `itervalues`).
     """
+    limit = opts.get('limit')  # Don't use bytestring
 
     # Get a list of config files which exist and are in scope.
-    configs = [c for c in getconfigs(ui, repo) if c[b'scope'] in scopes and c[b'exists']]
-
-    def confs():
-        for c in configs:
-            conf = config_file()
-            conf.read(c[b'path'])
-            yield c, conf
+    # With a limit, files are only read as they are needed.
+    configs = [c for c in getconfigs(ui, repo, prefetch=limit is None)
+               if c[b'scope'] in scopes and c[b'exists']]
+    index = configindex(configs, getparsecache(ui), getwarmcache(ui))
+
+    out = outputbuffer(ui)
+    fm = getformatter(ui, out, b'cfg', opts)
+    if fm is not None:
+        items = itervalues(ui, repo, index, configs, section, key)
+        for c, s, k, e, active in itertools.islice(items, limit):
+            fm.startitem()
+            if k is None:
+                fm.data(scope=c[b'scope'], path=c[b'path'], section=s)
+            else:
+                fm.data(scope=c[b'scope'], path=e.path, line=e.line,
+                        section=s, key=k, value=e.value, active=active)
+        fm.end()
+        out.flush()
+        return
 
     # If it's quiet, then we aren't indicating which file it came from,
     # so we may as well make it a unique list.
-    if ui.quiet and section is None:
+    if out.quiet and key is None and (section is None or isglob(section)):
         sections = set()
-        for c, conf in confs():
-            sections.update(conf.sections())
-        for s in sorted(sections):
-            uiwritesection(ui, s)
+        for c in configs:
+            if section is None:
+                sections.update(index.sections(c))
+            else:
+                sections.update(s for s, k, e in index.match(c, section))
+        for s in itertools.islice(sorted(sections), limit):
+            uiwritesection(out, s)
+        out.flush()
         return
 
     # Similar, but if it's not quiet, then we indicate which file each
     # section comes from, and don't make it unique.
-    if section is None:
-        for c, conf in confs():
-            uiwritescope(ui, c, ui.status)
-            uiwritefile(ui, c, ui.status)
-            for s in conf.sections():
-                uiwritesection(ui, s)
-            ui.status(b'\n')
+    if key is None and (section is None or isglob(section)):
+        current = None
+        items = itervalues(ui, repo, index, configs, section, key)
+        for c, s, k, e, active in itertools.islice(items, limit):
+            if c is not current:
+                if current is not None:
+                    out.status(b'\n')
+                current = c
+                uiwritescope(out, c, out.status)
+                uiwritefile(out, c, out.status)
+            uiwritesection(out, s)
+        if current is not None:
+            out.status(b'\n')
+        out.flush()
         return
 
     # List all unique items in the named section
-    if ui.quiet and key is None:
+    if out.quiet and key is None:
+        # Which entry is the active one for each key in the section, so that
+        # it can be marked. Values from other scopes count too, so that they
+        # can hide those in scope.
+        effective = effectiveconfig(ui, repo, index, section)
         items = dict()
-        for c, conf in confs():
-            items.update(conf.items(section))
-        uiwritesection(ui, section)
-
-        actvals = {}
-        for k, v in sorted(items.iteritems()):
-            key = b"%s.%s" % (section.replace(b".", b".."),
-                              k.replace(b".", b".."))
-            if key not in actvals:
-                actvals[key] = ui.config(section, k)
-            uiwriteitem(ui, k, v, c, active=(v == actvals[key]))
-        ui.write(b'\n')
+        for c in configs:
+            items.update(index.entries(c, section))
+        uiwritesection(out, section)
+
+        for k, e in itertools.islice(sorted(items.items()), limit):
+            uiwriteitem(out, k, e.value,
+                        active=(effective.get((section, k)) == e))
+        out.write(b'\n')
+        out.flush()
         return
 
     # Same, but if not quiet, don't make it unique.
     if key is None:
-        actvals = {}
-        for c, conf in confs():
-            if section in conf:
-                uiwritescope(ui, c, ui.status)
-                uiwritefile(ui, c, ui.status)
-                uiwritesection(ui, section, c)
-                for k, v in conf.items(section):
-                    key = b"%s.%s" % (section.replace(b".", b".."),
-                                      k.replace(b".", b".."))
-                    if key not in actvals:
-                        actvals[key] = ui.config(section, k)
-                    uiwriteitem(ui, k, v, c, active=(v == actvals[key]))
-                ui.status(b'\n')
+        current = None
+        items = itervalues(ui, repo, index, configs, section, key)
+        for c, s, k, e, active in itertools.islice(items, limit):
+            if c is not current:
+                if current is not None:
+                    out.status(b'\n')
+                current = c
+                uiwritescope(out, c, out.status)
+                uiwritefile(out, c, out.status)
+                uiwritesection(out, section, c)
+            if k is not None:
+                uiwriteitem(out, k, e.value, c, active=active)
+        if current is not None:
+            out.status(b'\n')
+        out.flush()
+        return
+
+    # Patterns can match several sections and keys, so show the values of
+    # each, like for a whole section.
+    if isglob(section) or isglob(key):
+        items = itervalues(ui, repo, index, configs, section, key)
+        if out.quiet:
+            # Only the active values, made unique.
+            active = sorted((s, k, e) for c, s, k, e, a in items if a)
+            items = ((None, s, k, e, True) for s, k, e in active)
+        current = cursection = None
+        for c, s, k, e, active in itertools.islice(items, limit):
+            if c is not current and c is not None:
+                if current is not None:
+                    out.status(b'\n')
+                current = c
+                cursection = None
+                uiwritescope(out, c, out.status)
+                uiwritefile(out, c, out.status)
+            if s != cursection:
+                cursection = s
+                uiwritesection(out, s, c)
+            uiwriteitem(out, k, e.value, c, active=active)
+        if current is not None:
+            out.status(b'\n')
+        elif cursection is not None:
+            out.write(b'\n')
+        out.flush()
         return
 
     # They specified both a section and a key, so find all values of it.
     output = []
     max_value_len = 0
-    for c in configs:
-        value = getvalue(ui, section, key, c[b'path'])
-        if value is not None:
-            output.append({b'p': c[b'path'], b'v': value, b's': c[b'scope']})
-            max_value_len = max([max_value_len, len(value)])
+    actualfound = False
+    items = itervalues(ui, repo, index, configs, section, key)
+    for c, s, k, e, active in itertools.islice(items, limit):
+        output.append({b'p': e.path, b'v': e.value, b's': c[b'scope'],
+                       b'a': active})
+        max_value_len = max([max_value_len, len(e.value)])
 
     maxscopelen = 0
     i18nscopes = {}
@@ -272,81 +2085,117 @@ def showvalue(ui, repo, section, key, scopes, **opts):
         i18nscopes[scope] = s
         maxscopelen = max([maxscopelen, len(s)])
 
-    actualval = ui.config(section, key)
-    actualfound = False
-
     scope_str = b" in %s config" % b'/'.join(scopes)
     if len(output) > 0:
-        ui.note(_(b'values found for '))
-        ui.note(b'%s.%s' % (section, key), label=b'hgcfg.keyname')
-        ui.note(_(scope_str + b":\n"))
+        out.note(_(b'values found for '))
+        out.note(b'%s.%s' % (section, key), label=b'hgcfg.keyname')
+        out.note(_(scope_str + b":\n"))
         for o in output:
 
             # Fore --quiet, only show the correct value.
-            if o[b'v'] == actualval:
+            if o[b'a']:
                 selected = b'.selected'
-                write = ui.write
+                write = out.write
                 prefix = b'* '
                 actualfound = True
             else:
                 selected = b''
-                write = ui.status
+                write = out.status
                 prefix = b'  '
             label = b'hgcfg.item.value' + selected
             write(prefix, label=label)
             write(o[b'v'], label=label)
 
             # Fill space before writing the scope and path.
-            ui.note(b'%*s' % (max_value_len - len(o[b'v']) + 2, b''))
+            out.note(b'%*s' % (max_value_len - len(o[b'v']) + 2, b''))
 
             # Write the scope and path
             scope = i18nscopes[o[b's']]
-            ui.note(_(b'('))
-            ui.note(scope, label=b'hgcfg.scope.' + o[b's'])
-            ui.note(_(b')'))
-            ui.note(b'%*s' % (maxscopelen - len(scope) + 1, b''))
-            ui.note(o[b'p'], label=b'hgcfg.file.' + o[b's'])
+            out.note(_(b'('))
+            out.note(scope, label=b'hgcfg.scope.' + o[b's'])
+            out.note(_(b')'))
+            out.note(b'%*s' % (maxscopelen - len(scope) + 1, b''))
+            out.note(o[b'p'], label=b'hgcfg.file.' + o[b's'])
 
             write(b"\n")
 
         if not actualfound:
-            ui.note(_(b"\ncurrent active value not in scope ("))
-            ui.note(str(actualval), label=b'hgcfg.item.value.selected')
-            ui.note(_(b")\n"))
+            with phase(b'resolve'):
+                actualval = ui.config(section, key)
+            out.note(_(b"\ncurrent active value not in scope ("))
+            out.note(pycompat.bytestr(actualval), label=b'hgcfg.item.value.selected')
+            out.note(_(b")\n"))
     else:
-        ui.note(_(b'no values found for '))
-        ui.note(b'%s.%s' % (section, key), label=b'hgcfg.keyname')
-        ui.note(_(scope_str + b":\n"))
+        out.note(_(b'no values found for '))
+        out.note(b'%s.%s' % (section, key), label=b'hgcfg.keyname')
+        out.note(_(scope_str + b":\n"))
+    out.flush()
+
+
+def itervalues(ui, repo, index, configs, section, key):
+    """
+    Generates what `showvalue` shows, in file order, as
+    `(config, section, key, configentry, active)` tuples: without a section,
+    one for each section of each file (with `key` and `configentry` set to
+    `None`), otherwise one for each value of each file (or just one, without
+    a key, for a file where the section is empty). Files are only read
+    as they are needed: to find out whether a value is active, the files
+    after the one it is assigned in are read until one of them assigns its
+    key again, see `activevalues`.
+
+    If the section or key is a glob pattern (see `isglob`), generates one
+    tuple for each matching section, or for each matching value, of each
+    file instead, sorted by section and key within each file.
+    """
+    if isglob(section) or isglob(key):
+        active = None
+        for c in configs:
+            matches = index.match(c, section, key)
+            if key is not None and active is None and matches:
+                active = activevalues(ui, repo, index, prefetch=False)
+            for s, k, e in matches:
+                yield c, s, k, e, k is not None and active.isactive(c, s, k)
+        return
+
+    if section is None:
+        for c in configs:
+            for s in index.sections(c):
+                yield c, s, None, None, False
+        return
+
+    # Values from other scopes count too, since they can hide those in scope.
+    active = activevalues(ui, repo, index, prefetch=False)
+    for c in configs:
+        if key is None:
+            entries = index.entries(c, section)
+            if not entries and section in index.parsed(c).data:
+                yield c, section, None, None, False
+        else:
+            values = index.values(c, section, key)
+            entries = [(key, values[-1])] if values else []
+        for k, e in entries:
+            yield c, section, k, e, active.isactive(c, section, k)
 
 
 def getvalue(ui, section, key, rcfile):
     """
-    Returns the value of the specified key from the specified config file.
+    Returns the value of the specified key from the specified config file, as
+    hg would read it (i.e., the last one).
     """
     values = getvalues(ui, section, key, rcfile)
     if len(values) == 0:
         return None
     else:
-        return values[0]
+        return values[-1]
 
 
 def getvalues(ui, section, key, rcfile):
     """
-    Returns all values of the specified key found in the specified file.
-    """
-    inside_section = False
-    values = []
-    with open(rcfile, 'rb') as f:
-        for line in f:
-            m = re.match(br"^\s*\[(.*)\]", line)
-            if m:
-                inside_section = section == m.group(1)
-            else:
-                if inside_section:
-                    m = re.match(br"\s*" + re.escape(key) + br"\s*=(.*)", line)
-                    if m:
-                        values.append(m.group(1).strip())
-    return values
+    Returns all values of the specified key found in the specified file, or
+    the files it includes, since the key was last `%unset`.
+    """
+    graph = includegraph(warm=getwarmcache(ui))
+    return [e.value for e in parsedconfig(rcfile, graph=graph).values(section, key)]
 
 
 def getconfigchoice(ui, configs, start_msg, prompt_msg, default=0):
@@ -362,8 +2211,8 @@ def getconfigchoice(ui, configs, start_msg, prompt_msg, default=0):
         ui.status(_(b"\n"))
         i += 1
 
-    choice = ui.prompt(prompt_msg + _(b": [%s]" % (bytes(default))),
-                       default=bytes(default))
+    choice = ui.prompt(prompt_msg + _(b": [%d]" % default),
+                       default=b'%d' % default)
 
     try:
         choice = int(choice)
@@ -395,30 +2244,115 @@ def getwriteableconfigs(ui, repo, scopes):
     return writeable_configs
 
 
-def writevalue(ui, repo, section, key, value, scopes):
+def choosewriteableconfig(ui, repo, scopes, prompt_msg, status_msg,
+                          choice=None):
+    """
+    Returns the path of the writeable config file within the given scopes
+    that should be written to, asking the user to choose if there is more than
+    one. Returns `None` (after warning the user) if there is none to choose,
+    or if they make an invalid choice.
 
+    If `choice` is given, it is used instead of asking the user, as an index
+    into the files they would have been asked to choose from.
+    """
     # may have a choice of files to edit from, start from bottom
     writeable_configs = getwriteableconfigs(ui, repo, scopes)
     if len(writeable_configs) < 1:
         ui.warn(_(b"no writeable configs to write value to, "
                   b"try 'hg listconfigs'\n"))
-        return False
+        return None
 
     if len(writeable_configs) == 1:
-        return writevaluetofile(ui, repo, section, key, value,
-                                writeable_configs[0][b'path'])
+        return writeable_configs[0][b'path']
+    elif choice is not None:
+        if choice < 0 or choice > (len(writeable_configs) - 1):
+            ui.warn(_(b"invalid choice\n"))
+            return None
+        return writeable_configs[choice][b'path']
     else:
         # give them a choice
         choice = getconfigchoice(ui, writeable_configs,
                                  _(b"multiple config files to choose from, please select:\n"),
-                                 _(b"which file do you want to write to"))
+                                 prompt_msg)
         if choice is False:
             ui.warn(_(b"invalid choice\n"))
-            return False
+            return None
         else:
-            ui.status(_(b"writing value to config [%d]\n" % choice))
-            return writevaluetofile(ui, repo, section, key, value,
-                                    writeable_configs[int(choice)][b'path'])
+            ui.status(status_msg % choice)
+            return writeable_configs[int(choice)][b'path']
+
+
+def writevalue(ui, repo, section, key, value, scopes, choice=None):
+    rcfile = choosewriteableconfig(ui, repo, scopes,
+                                   _(b"which file do you want to write to"),
+                                   _(b"writing value to config [%d]\n"),
+                                   choice)
+    if rcfile is None:
+        return False
+    return writevaluetofile(ui, repo, section, key, value, rcfile)
+
+
+def writeops(ui, repo, ops, scopes, choice=None):
+    """
+    Like `writevalue`, but applies a sequence of operations (see
+    `writeopstofile_`) to the chosen config file at once.
+    """
+    rcfile = choosewriteableconfig(ui, repo, scopes,
+                                   _(b"which file do you want to write to"),
+                                   _(b"writing values to config [%d]\n"),
+                                   choice)
+    if rcfile is None:
+        return False
+    return writeopstofile(ui, repo, ops, rcfile)
+
+
+def compactconfig(ui, repo, scopes, choice=None, dryrun=False):
+    """
+    Compacts the chosen config file with `_compactlines`, and tells the user
+    how many lines and bytes that saved. With `dryrun`, the file is left as
+    it is, and the user is told what would have been saved instead.
+    """
+    rcfile = choosewriteableconfig(ui, repo, scopes,
+                                   _(b"which file do you want to compact"),
+                                   _(b"compacting config [%d]\n"),
+                                   choice)
+    if rcfile is None:
+        return False
+
+    finder = getfinder()
+    finder.forget(rcfile)
+    rcfile = os.path.realpath(rcfile)
+    finder.forget(rcfile)
+
+    with lockconfigfile(ui, rcfile):
+        try:
+            with open(rcfile, 'rb') as f:
+                data = f.read()
+        except IOError as inst:
+            if inst.errno != errno.ENOENT:
+                raise
+            data = b''
+        lines = data.splitlines(True)
+        compacted, removed = _compactlines(lines)
+        newdata = b''.join(compacted)
+        if newdata != data and not dryrun:
+            with util.atomictempfile(rcfile, b'wb') as out:
+                out.write(newdata)
+
+    ui.note(_(b"%d shadowed values, %d commented-out values, "
+              b"%d duplicate section headers\n")
+            % (removed[b'shadowed'], removed[b'commented'], removed[b'headers']))
+    if newdata == data:
+        ui.status(_(b"config file %s unchanged\n") % rcfile)
+    elif dryrun:
+        ui.status(_(b"compacting %s would save %d lines, %d bytes\n")
+                  % (rcfile, len(lines) - len(compacted),
+                     len(data) - len(newdata)))
+    else:
+        ui.status(_(b"compacted %s, saved %d lines, %d bytes\n")
+                  % (rcfile, len(lines) - len(compacted),
+                     len(data) - len(newdata)))
+    return True
 
 
 def writevaluetofile_(ui, repo, section, key, value, rcfile, delete):
@@ -426,64 +2360,746 @@ def writevaluetofile_(ui, repo, section, key, value, rcfile, delete):
     Updates the given config file to assign the specified value to the specified
     key. If the key already exists in the file, then it is either overwritten
     (if `delete` is True), or it is commented out and the new value is written
-    before it.
+    before it. If `value` is None, the key is only deleted or commented out.
+    """
+    if value is None:
+        op = (b'delete', section, key)
+    else:
+        op = (b'set', section, key, value)
+    return writeopstofile_(ui, repo, [op], rcfile, delete)
+
+
+# A section header, as matched when rewriting config files.
+_headerre = lazyre(br"^\s*\[(.*)\]")
+
+# Any assignment to a key, as matched when rewriting config files.
+_assignre = lazyre(br"\s*([^=\s;#][^=]*?)\s*=")
+
+
+class _rewriteplan(object):
     """
+    Works out what a sequence of operations means for each line of a config
+    file, so that all of them can be applied in a single pass over it.
 
-    inside_section = False
-    wrote_value = False
-    new = b''
+    Each operation is a tuple, one of:
 
-    with open(rcfile, 'rb') as f:
-        for line in f:
-            m = re.match(br"^\s*\[(.*)\]", line)
-            if m:
-                if section == m.group(1):
-                    inside_section = True
-                    new += line
-                    if not wrote_value and value is not None:
-                        new += (b"%s = %s\n" % (key, value))
-                        wrote_value = True
-                else:
-                    inside_section = False
-                    new += line
+    `(b'set', section, key, value)`
+        Assign the value to the key.
+
+    `(b'delete', section, key)`
+        Delete the key.
+
+    `(b'delete-section', section)`
+        Delete the section and all keys in it.
+
+    `(b'rename-section', old, new)`
+        Rename the section.
+
+    Operations apply in order, so for instance a `set` following a
+    `rename-section` must name the new section.
+
+    `includes` is set once a rewrite of the file has come across an
+    `%include`.
+    """
+
+    def __init__(self, ops):
+        self.ops = list(ops)
+        self.includes = False
+        self._sections = {}
+        self._keys = {}
+        # The sections named by the operations. No key in any other section
+        # is affected, so they need not be remembered for each one.
+        self._touched = set(op[1] for op in self.ops)
+
+        # The values left to write at the end, by (final) section name.
+        self.pending = util.sortdict()
+        for op in self.ops:
+            if op[0] == b'set':
+                self.pending.setdefault(op[1], util.sortdict())[op[2]] = op[3]
+            elif op[0] == b'delete':
+                self.pending.get(op[1], {}).pop(op[2], None)
+            elif op[0] == b'delete-section':
+                self.pending.pop(op[1], None)
+            elif op[0] == b'rename-section':
+                values = self.pending.pop(op[1], None)
+                if values:
+                    self.pending.setdefault(op[2], util.sortdict()).update(values)
             else:
-                if inside_section:
-                    m = re.match(br"\s*" + re.escape(key) + br"\s*=(.*)", line)
-                    if m:
-                        if not delete:
-                            new += b';' + line
-                    else:
-                        new += line
-                else:
-                    new += line
+                raise error.ProgrammingError(b'unknown operation: %s' % op[0])
+
+    def section(self, name):
+        """
+        Returns what a section header of the file with the given name becomes
+        once all operations have been applied: the new name of the section,
+        or `None` if it is deleted.
+        """
+        if name not in self._sections:
+            cur = name
+            for op in self.ops:
+                if op[1] != cur:
+                    continue
+                if op[0] == b'rename-section':
+                    cur = op[2]
+                elif op[0] == b'delete-section':
+                    cur = None
+                    break
+            self._sections[name] = cur
+        return self._sections[name]
+
+    def replaced(self, section, key):
+        """
+        Returns True if an existing assignment of the key, in a section
+        that had the given name in the file, is affected by the operations.
+        """
+        if section not in self._touched:
+            return False
+        if (section, key) not in self._keys:
+            cur = section
+            replaced = False
+            for op in self.ops:
+                if op[1] != cur:
+                    continue
+                if op[0] == b'rename-section':
+                    cur = op[2]
+                elif op[0] == b'delete-section':
+                    replaced = True
+                    break
+                elif op[2] == key:
+                    replaced = True
+                    break
+            self._keys[(section, key)] = replaced
+        return self._keys[(section, key)]
+
+
+def _rewritelines(plan, lines, delete):
+    """
+    Generates the lines of a config file, given the lines it has now, after
+    applying a `_rewriteplan` to it. See `writeopstofile_`.
+    """
+    pending = util.sortdict(plan.pending)
+    section = None
+    dropping = False
+    last = None
+    # Comments following an assignment that we are replacing, which are part
+    # of it if more continuation lines follow them, since hg skips them.
+    held = []
+    for line in lines:
+        if dropping and held is not None and _commentre.match(line):
+            held.append(line)
+            continue
+        if held:
+            if dropping and line[:1].isspace() and line.strip():
+                if not delete:
+                    for l in held:
+                        yield l
+            else:
+                for l in held:
+                    last = l
+                    yield last
+            held = []
+
+        m = _headerre.match(line)
+        if m:
+            dropping = False
+            section = m.group(1)
+            name = plan.section(section)
+            if name is None:
+                if not delete:
+                    last = b';' + line
+                    yield last
+            elif name != section:
+                last = line.replace(b'[%s]' % section, b'[%s]' % name, 1)
+                yield last
+            else:
+                last = line
+                yield last
+            values = pending.pop(name, None) if name is not None else None
+            if values:
+                for k, v in values.items():
+                    last = _assignment(k, v)
+                    yield last
+            continue
+
+        if dropping and line[:1].isspace() and line.strip():
+            # A continuation of an assignment that we are replacing.
+            if not delete:
+                last = b';' + line
+                yield last
+            continue
+        dropping = False
+
+        if _includere.match(line):
+            plan.includes = True
 
-    # if we haven't written the value yet it's because we never found the
+        if section is not None:
+            name = plan.section(section)
+            held = None
+            if name is None:
+                dropping = True
+            else:
+                m = _assignre.match(line)
+                if m:
+                    dropping = plan.replaced(section, m.group(1))
+                    if dropping:
+                        held = []
+                else:
+                    # An %unset of a key we are setting would undo it.
+                    m = _unsetre.match(line)
+                    dropping = (bool(m) and
+                                m.group(1) in plan.pending.get(name, ()))
+            if dropping:
+                if not delete and not _emptyre.match(line):
+                    last = b';' + line
+                    yield last
+                elif not delete:
+                    last = line
+                    yield last
+                continue
+        last = line
+        yield last
+
+    for l in held or ():
+        last = l
+        yield last
+
+    # if we haven't written values yet it's because we never found the
     # right section, so we'll make it now
-    if not wrote_value and value is not None:
-        new += b"\n[%s]\n%s = %s\n" % (section, key, value)
+    for name, values in pending.items():
+        if not values:
+            continue
+        if last is not None:
+            if not last.endswith(b'\n'):
+                yield b'\n'
+            yield b'\n'
+        yield b"[%s]\n" % name
+        for k, v in values.items():
+            last = _assignment(k, v)
+            yield last
+
+
+def _compactunits(lines):
+    """
+    Splits the lines of a config file into `[kind, section, key, lines]`
+    units for `_compactlines`, where kind is one of:
+
+    `b'header'`
+        A section header, whose name is `section`.
+
+    `b'set'`
+        An assignment to `key`, with its continuation lines, and the comments
+        between them.
+
+    `b'commented'`
+        An assignment to `key` which was commented out with ';' (as `cfg`
+        does when it replaces a value), with its commented continuation
+        lines.
+
+    `b'unset'`, `b'include'`
+        A `%unset` of `key`, or an `%include`.
+
+    `b'other'`
+        Anything else: empty lines, comments, and commented out assignments
+        after a commented out header.
+
+    `section` is `None` before the first header.
+    """
+    units = []
+    state = {b'section': None, b'commented': False}
+
+    def add(line):
+        last = units[-1] if units else None
+        section = state[b'section']
+        if (last is not None and last[0] == b'commented' and
+                line[:1] == b';' and _contre.match(line[1:])):
+            last[3].append(line)
+            return
+
+        m = _sectionre.match(line)
+        if m:
+            state[b'section'] = m.group(1)
+            state[b'commented'] = False
+            units.append([b'header', m.group(1), None, [line]])
+            return
+        if _emptyre.match(line):
+            kind, key = b'other', None
+            if line[:1] == b';':
+                if _sectionre.match(line[1:]):
+                    state[b'commented'] = True
+                elif not state[b'commented'] and section is not None:
+                    m = _itemre.match(line[1:])
+                    if m:
+                        kind, key = b'commented', m.group(1)
+            units.append([kind, section, key, [line]])
+            return
+        if _includere.match(line):
+            units.append([b'include', section, None, [line]])
+            return
+        m = _itemre.match(line)
+        if m:
+            units.append([b'set', section, m.group(1), [line]])
+            return
+        m = _unsetre.match(line)
+        if m:
+            units.append([b'unset', section, m.group(1), [line]])
+            return
+        units.append([b'other', section, None, [line]])
+
+    # Comments right after an assignment belong to it if they are followed
+    # by more of its continuation lines, since they are skipped then.
+    comments = []
+    for line in lines:
+        last = units[-1] if units else None
+        if last is not None and last[0] == b'set':
+            if _contre.match(line):
+                last[3].extend(comments)
+                last[3].append(line)
+                comments = []
+                continue
+            if _commentre.match(line):
+                comments.append(line)
+                continue
+        for l in comments:
+            add(l)
+        comments = []
+        add(line)
+    for l in comments:
+        add(l)
+    return units
+
+
+def _compactlines(lines):
+    """
+    Returns the lines of a config file once compacted, along with a dict
+    counting what was removed:
+
+    `b'shadowed'`
+        Assignments of a key which is assigned again, or `%unset`, later in
+        the same section, so that they have no effect. `%unset`s are kept,
+        since they also unset the key for the config files read before.
+
+    `b'commented'`
+        Assignments commented out with ';' of a key which is assigned in the
+        same section, like those `cfg` leaves behind when replacing values.
+
+    `b'headers'`
+        Headers of sections which already appeared earlier in the file. The
+        contents of the section are moved up to follow its first header,
+        unless there is an `%include` in between, since the included file
+        might set the same keys.
+
+    Other lines are kept as they are, in the same order.
+    """
+    units = _compactunits(lines)
+    removed = {b'shadowed': 0, b'commented': 0, b'headers': 0}
+
+    live = set()
+    seen = set()
+    kept = []
+    for u in reversed(units):
+        kind, section, key = u[:3]
+        if kind == b'set':
+            if (section, key) in seen:
+                removed[b'shadowed'] += 1
+                continue
+            live.add((section, key))
+        if kind in (b'set', b'unset'):
+            seen.add((section, key))
+        kept.append(u)
+    kept.reverse()
+
+    # The sections of each run of lines between %includes (which is kept at
+    # the end of the run), by name, as lists of: the header (if any, since a run can start in the middle of a
+    # section), the units which follow it, the empty lines after those, and
+    # the empty lines which ended the section where it first appeared. Those
+    # stay last when more of the section is moved up to it, since they are
+    # what separated it from the next one.
+    runs = [[util.sortdict(), None]]
+    section = None
+    for u in kept:
+        kind = u[0]
+        if kind == b'commented' and (u[1], u[2]) in live:
+            removed[b'commented'] += 1
+            continue
+        if kind == b'include':
+            runs[-1][1] = u
+            runs.append([util.sortdict(), None])
+            continue
+        blocks = runs[-1][0]
+        if kind == b'header':
+            section = u[1]
+            block = blocks.get(section)
+            if block is not None:
+                removed[b'headers'] += 1
+                if not block[3]:
+                    block[3], block[2] = block[2], []
+                continue
+            blocks[section] = [u, [], [], []]
+            continue
+        block = blocks.get(section)
+        if block is None:
+            block = blocks[section] = [None, [], [], []]
+        if kind == b'other' and not u[3][0].strip():
+            block[2].append(u)
+            continue
+        block[1].extend(block[2])
+        block[2] = []
+        block[1].append(u)
+
+    compacted = []
+    for blocks, include in runs:
+        order = list(blocks)
+        if (include is not None and include[1] in blocks and
+                order[-1] != include[1]):
+            # What follows the %include is in the section it is in, so that
+            # one must come last.
+            order.remove(include[1])
+            order.append(include[1])
+            if blocks[include[1]][0] is None:
+                header = b'[%s]\n' % include[1]
+                blocks[include[1]][0] = [b'header', include[1], None, [header]]
+        for name in order:
+            header, body, empty, separator = blocks[name]
+            if header is not None:
+                compacted.extend(header[3])
+            for u in body + (separator or empty):
+                compacted.extend(u[3])
+        if include is not None:
+            compacted.extend(include[3])
+    return compacted, removed
+
+
+def _assignment(key, value):
+    """
+    Returns the line(s) assigning the value to the key in a config file.
+    Values spanning several lines are written as continuation lines.
+    """
+    return b"%s = %s\n" % (key, value.replace(b'\n', b'\n  '))
+
 
-    # write new file
-    with open(rcfile, 'wb') as f:
-        f.write(new)
+def writeopstofile_(ui, repo, ops, rcfile, delete):
+    """
+    Applies a sequence of operations, as described by `_rewriteplan`, to the
+    given config file, reading and writing it only once.
+
+    Assignments that are replaced or deleted are either removed (if `delete`
+    is True), or commented out, as are `%unset`s of keys that are set. New
+    values are written right after the first header of their section, and
+    sections that do not exist yet are added at the end of the file. A config
+    file which does not exist yet is created. If a value that was set is
+    overridden by a file that the config file `%include`s, the user is
+    warned.
+
+    The new contents are streamed into a temporary file next to the config
+    file, which then atomically replaces it (keeping its permissions), so
+    that readers never see a partially written file. If the config file is
+    a symlink, the file it points to is replaced instead. The file is locked
+    while this happens, see `lockconfigfile`.
+
+    Values which the file already sets (see `_unchangedops`) are left alone.
+    The new contents are compared with the file as they are written, and if
+    they turn out to be the same, the temporary file is discarded, so that
+    the file's modification time stays the same, and the user is told that
+    it is unchanged.
+    """
+    # What was found out about the file will soon be out of date.
+    finder = getfinder()
+    finder.forget(rcfile)
+    rcfile = os.path.realpath(rcfile)
+    finder.forget(rcfile)
+
+    with lockconfigfile(ui, rcfile):
+        try:
+            f = open(rcfile, 'rb')
+        except IOError as inst:
+            if inst.errno != errno.ENOENT:
+                raise
+            f = None
+
+        try:
+            if f is not None:
+                unchanged = _unchangedops(ops, rcfile, f)
+                ops = [op for i, op in enumerate(ops) if i not in unchanged]
+                f.seek(0)
+            plan = _rewriteplan(ops)
+            if not _rewritefile(plan, f, rcfile, delete):
+                ui.status(_(b"config file %s unchanged\n") % rcfile)
+                return True
+        finally:
+            if f is not None:
+                f.close()
+
+    if plan.includes and plan.pending:
+        parsed = parsedconfig(rcfile)
+        for section, values in plan.pending.items():
+            for key in values:
+                e = parsed.data.get(section, {}).get(key)
+                if e is None:
+                    ui.warn(_(b"%s.%s is unset again by a file included "
+                              b"from %s\n") % (section, key, rcfile))
+                elif e.path != rcfile:
+                    ui.warn(_(b"%s.%s is overridden by %s:%d\n")
+                            % (section, key, e.path, e.line))
     return True
 
 
+def _rewritefile(plan, f, rcfile, delete):
+    """
+    Streams the given config file, open as `f` (or `None` if it does not
+    exist), rewritten by `_rewritelines`, into a temporary file which then
+    replaces it. The file is read once more alongside, to compare what is
+    written with it, and if they turn out to be the same, the temporary file
+    is discarded instead. Returns whether the file was replaced.
+    """
+    old = open(rcfile, 'rb') if f is not None else None
+    out = util.atomictempfile(rcfile, b'wb')
+    try:
+        same = True
+        for line in _rewritelines(plan, f if f is not None else (), delete):
+            out.write(line)
+            if same:
+                same = old is not None and old.read(len(line)) == line
+        if same and old is not None:
+            same = not old.read(1)
+        if same:
+            out.discard()
+        else:
+            out.close()
+        return not same
+    finally:
+        out.discard()
+        if old is not None:
+            old.close()
+
+
+def _unchangedops(ops, rcfile, f):
+    """
+    Returns the set of indexes of the `b'set'` operations in `ops` which
+    would not change anything, given the config file, open as `f`: those
+    assigning a key the value it already has in the file (not counting the
+    files it `%include`s), which no other operation touches.
+    """
+    keys = set((op[1], op[2]) for op in ops if op[0] == b'set')
+    if not keys:
+        return set()
+    # The file is split into lines like hg does, while only holding one
+    # line of it at a time.
+    lines = itertools.chain.from_iterable(l.splitlines(True) for l in f)
+    try:
+        node = parseconfiglines(rcfile, lines, keys=keys)
+    except error.ConfigError:
+        return set()
+    values = {}
+    for ev in node.events:
+        if ev[0] == b'set':
+            values[(ev[1], ev[2])] = ev[3]
+        elif ev[0] == b'unset':
+            values.pop((ev[1], ev[2]), None)
+
+    touched = collections.Counter()
+    for op in ops:
+        if op[0] in (b'set', b'delete'):
+            touched[(op[1], op[2])] += 1
+        else:
+            touched[op[1]] += 1
+            if op[0] == b'rename-section':
+                touched[op[2]] += 1
+
+    unchanged = set()
+    for i, op in enumerate(ops):
+        if (op[0] == b'set' and touched[(op[1], op[2])] == 1
+                and not touched[op[1]] and values.get((op[1], op[2])) == op[3]):
+            unchanged.add(i)
+    return unchanged
+
+
+def lockconfigfile(ui, rcfile):
+    """
+    Locks the given config file for changing it, and returns the lock. Other
+    hgcfg processes wait for the lock before they read the file to change
+    it, so that no changes get lost.
+
+    The lock is a ".lock" file next to the config file, and works like hg's
+    repository locks: it is waited for for up to "ui.timeout" seconds, and a
+    lock left behind by a process which has died is broken. Only writers
+    take the lock. Since config files are replaced atomically, readers see
+    either the old or the new contents.
+    """
+    vfs = vfsmod.vfs(os.path.dirname(rcfile))
+    return lockmod.trylock(ui, vfs, os.path.basename(rcfile) + b'.lock',
+                           ui.configint(b'ui', b'timeout'),
+                           ui.configint(b'ui', b'timeout.warn'),
+                           desc=rcfile)
+
+
+def writeopstofile(ui, repo, ops, rcfile):
+    """
+    Simple delegate to `writeopstofile_`, but gets the `delete` parameter from
+    the `hgcfg.delete_on_replace` configuration value.
+    """
+    return writeopstofile_(ui, repo, ops, rcfile, deleteonreplace(ui))
+
+
+# A SECTION or SECTION.KEY argument.
+_keyre = lazyre(br"(?:([a-z_][a-z0-9_-]*)(?:\.([a-z_][a-z0-9._-]*))?)?$", re.I)
+
+# Like `_keyre`, but either name can be a glob pattern (see `isglob`).
+_globkeyre = lazyre(br"(?:([a-z0-9_*?-]+)(?:\.([a-z0-9._*?-]+))?)?$", re.I)
+
+
+def splitkey(key):
+    """
+    Splits a SECTION or SECTION.KEY argument into a `(section, key)` pair,
+    either of which may be `None`. Returns `(None, None)` if the argument is
+    not valid.
+    """
+    m = _keyre.match(key)
+    if not m:
+        return None, None
+    return m.group(1), m.group(2)
+
+
+# A SECTION or SECTION.KEY in a batch of operations. Any key hg can read from
+# a config file can be given, so the key goes up to the end (with no '=' in
+# it), and only the section ends at the first '.'.
+_batchkeyre = lazyre(br"([^.\s\[\]=]+)(?:\.([^=\s]+))?$")
+
+
+def splitbatchkey(key):
+    """
+    Like `splitkey`, but for a SECTION or SECTION.KEY in a batch of
+    operations (see `parsebatch`).
+    """
+    m = _batchkeyre.match(key)
+    if not m:
+        return None, None
+    return m.group(1), m.group(2)
+
+
+def parsebatch(data, source=b'<batch>'):
+    """
+    Parses a batch of operations for `writeopstofile_`, one per line:
+
+        set SECTION.KEY VALUE
+        delete SECTION.KEY
+        delete-section SECTION
+        rename-section OLD NEW
+
+    Empty lines and lines starting with '#' or ';' are ignored. Raises
+    `error.Abort` on the first line that cannot be parsed.
+    """
+    ops = []
+    for lineno, line in enumerate(data.splitlines(), 1):
+        op = parsebatchline(line, source, lineno)
+        if op is not None:
+            ops.append(op)
+    return ops
+
+
+def parsebatchline(line, source, lineno):
+    """
+    Parses a single line of a batch of operations (see `parsebatch`), which
+    is the given line of the given file, and returns the operation, or `None`
+    if the line is empty or a comment.
+    """
+    line = line.strip()
+    if not line or line[:1] in (b'#', b';'):
+        return None
+    parts = line.split(None, 1)
+    op = parts[0]
+    args = parts[1] if len(parts) > 1 else b''
+    if op == b'set':
+        args = args.split(None, 1)
+        section, key = splitbatchkey(args[0] if args else b'')
+        if section and key:
+            return (op, section, key, args[1] if len(args) > 1 else b'')
+    elif op == b'delete':
+        section, key = splitbatchkey(args)
+        if section and key:
+            return (op, section, key)
+    elif op == b'delete-section':
+        section, key = splitbatchkey(args)
+        if section and not key:
+            return (op, section)
+    elif op == b'rename-section':
+        args = args.split()
+        if len(args) == 2:
+            old, key = splitbatchkey(args[0])
+            new, newkey = splitbatchkey(args[1])
+            if old and new and not key and not newkey:
+                return (op, old, new)
+    raise error.Abort(_(b"invalid batch operation at %s:%d: %s")
+                      % (source, lineno, line))
+
+
+def parsesnapshot(data, source=b'<snapshot>'):
+    """
+    Parses a snapshot written by `exportconfig`, which is like a batch of
+    operations (see `parsebatch`) with two additions: a line of the form
+
+        scope SCOPE
+
+    says which scope the following operations belong in, and a line starting
+    with whitespace continues the value of the `set` operation before it.
+
+    Returns a list of `(scope, ops)` pairs, where `scope` is `None` for
+    operations that come before any `scope` line. Raises `error.Abort` on
+    the first line that cannot be parsed.
+    """
+    groups = []
+    ops = []
+    scope = None
+    for lineno, line in enumerate(data.splitlines(), 1):
+        if line[:1].isspace() and line.strip():
+            if not ops or ops[-1][0] != b'set':
+                raise error.Abort(_(b"invalid snapshot line at %s:%d: %s")
+                                  % (source, lineno, line))
+            ops[-1] = ops[-1][:3] + (ops[-1][3] + b'\n' + line.strip(),)
+            continue
+        parts = line.split(None, 1)
+        if parts and parts[0] == b'scope':
+            if len(parts) != 2 or parts[1].strip() not in (b'local', b'user',
+                                                           b'global'):
+                raise error.Abort(_(b"invalid snapshot line at %s:%d: %s")
+                                  % (source, lineno, line))
+            if ops:
+                groups.append((scope, ops))
+                ops = []
+            scope = parts[1].strip()
+            continue
+        op = parsebatchline(line, source, lineno)
+        if op is not None:
+            ops.append(op)
+    if ops:
+        groups.append((scope, ops))
+    return groups
+
+
 def writevaluetofile(ui, repo, section, key, value, rcfile):
     """
     Simple delegte to `writevaluetofile_`, but gets the `delete` parameter from
     the `hgcfg.delete_on_replace` configuration value.
     """
+    return writevaluetofile_(ui, repo, section, key, value, rcfile,
+                             deleteonreplace(ui))
+
+
+def deleteonreplace(ui):
+    """
+    Returns the `hgcfg.delete_on_replace` configuration value (falling back
+    to the old `config.delete_on_replace`).
+    """
     delete = ui.configbool(b"hgcfg", b"delete_on_replace", None)
     if delete is None:
         delete = ui.configbool(b"config", b"delete_on_replace", False)
-    return writevaluetofile_(ui, repo, section, key, value, rcfile, delete)
+    return delete
 
 
 def editconfigfile(ui, rc_file):
     """
     Allows the user to edit the specified config file. This uses the
     `ui.edit` function, similar to the one used for editing commit
-    messages.
+    messages. If the file is changed by someone else before the editor is
+    closed, the edited contents are saved next to it instead.
     """
     with open(rc_file, 'rb') as f:
         orig_contents = f.read()
@@ -493,18 +3109,35 @@ def editconfigfile(ui, rc_file):
     new_contents = ui.edit(contents, ui.username())
     new_contents = re.sub(br'^%s' % re.escape(banner), b'', new_contents)
 
-    if new_contents != orig_contents:
-        with open(rc_file, 'wb') as f:
+    if new_contents == orig_contents:
+        return
+
+    # The file is not locked while the editor is open, which may be for a
+    # long time, so make sure it wasn't changed in the meantime.
+    getfinder().forget(rc_file)
+    rc_file = os.path.realpath(rc_file)
+    with lockconfigfile(ui, rc_file):
+        with open(rc_file, 'rb') as f:
+            changed = f.read() != orig_contents
+        if changed:
+            saved = rc_file + b'.edited'
+            with open(saved, 'wb') as f:
+                f.write(new_contents)
+            raise error.Abort(_(b"%s was changed while it was being edited")
+                              % rc_file,
+                              hint=_(b"your changes were saved in %s")
+                              % saved)
+        with util.atomictempfile(rc_file, b'wb') as f:
             f.write(new_contents)
 
 
-@replace_deprecated("editconfig")  # Don't use bytestring
 @command(b"editcfg",
          [(b'l', b'local', None, b'edit local config file (default)'),
           (b'u', b'user', None, b'edit per-user config file(s)'),
           (b'g', b'global', None, b'edit global config file(s)')],
          b"[options]",
          optionalrepo=True)
+@commandstate
 def editcfg(ui, repo, **opts):
     """edits your local or global hg configuration file
 
@@ -549,15 +3182,44 @@ def editcfg(ui, repo, **opts):
             return editconfigfile(ui, writeable_configs[int(choice)][b'path'])
 
 
-@replace_deprecated('config')  # Don't use bytestring
 @command(b"cfg",
          [(b'd', b'delete', None, b'delete SECTION.KEY'),
           (b'l', b'local', None, b'use local config file (default for set)'),
           (b'u', b'user', None, b'use per-user config file(s)'),
-          (b'g', b'global', None, b'use global config file(s)')],
+          (b'g', b'global', None, b'use global config file(s)'),
+          (b'', b'batch', b'',
+           b'apply the operations listed in FILE (- for stdin)', b'FILE'),
+          (b'', b'blame', None,
+           b'show where the effective value of each key comes from'),
+          (b'', b'grep', b'',
+           b'show the keys and values matching PATTERN', b'PATTERN'),
+          (b'', b'keys', None, b'with --grep, only search keys'),
+          (b'', b'values', None, b'with --grep, only search values'),
+          (b'', b'diff', b'',
+           b'show how the config of another repository differs', b'OTHER'),
+          (b'', b'digest', None, b'show a digest of the effective config'),
+          (b'', b'all-sources', None,
+           b'with --digest, also cover environment variables, the defaults '
+           b'of hg and --config'),
+          (b'', b'limit', b'', b'show at most N sections or values', b'N'),
+          (b'', b'export', None, b'write out a snapshot of the config'),
+          (b'', b'import', b'',
+           b'apply the snapshot in FILE (- for stdin)', b'FILE'),
+          (b'', b'compact', None,
+           b'remove shadowed and commented-out values from a config file'),
+          (b'n', b'dry-run', None,
+           b'with --compact, only report what would be saved'),
+          (b'', b'choice', -1,
+           b'write to the N-th writeable config file instead of asking', b'N')
+         ] + fleetopts + [
+          (b'', b'cache-stats', None, b'show statistics about the parse cache'),
+          (b'', b'cache-clear', None, b'remove all entries from the parse cache'),
+          (b'', b'profile-phases', None, b'report the time taken by each phase')
+         ] + cmdutil.formatteropts,
          b"[options] [SECTION[.KEY [NEW_VALUE]]]",
          optionalrepo=True)
-def cfg(ui, repo, key=b'', value=None, **opts):
+@commandstate
+def cfg(ui, repo, key=b'', value=None, *sections, **opts):
     """view or modify a configuration value
 
     To view all configuration sections across all files:
@@ -604,6 +3266,14 @@ def cfg(ui, repo, key=b'', value=None, **opts):
     file are printed for each value. With the --quiet option, only the lowest
     (most active) value is printed.
 
+    The section and key names can be glob patterns, where '*' matches any
+    number of characters and '?' matches a single one, for example
+    "paths.build-*" or "merge-tools.*.args". Every matching value is printed,
+    grouped by file and section as for a whole section, or with the --quiet
+    option only the active ones. A section pattern alone lists the matching
+    sections. Names are looked up in sorted order, so a pattern with a literal
+    prefix only looks at the names which start with it.
+
     In all of the above cases, the default is to use all relevant config files.
     This can be refined by specifying the --local, --user, or --global option.
     These options can be combined, but if any are present, then only those
@@ -615,6 +3285,8 @@ def cfg(ui, repo, key=b'', value=None, **opts):
     can modify this by using the --local, --user, or --global option. If
     multiple files are found, you will be presented which a choice of which to
     modify. Note that only files which are writeable by you are considered.
+    If the key already has that value in the chosen file, or a key which is
+    deleted is not in it, the file is left untouched and reported unchanged.
 
     When the --delete option is given, there must be exactly one argument given,
     and it must contain both the section name and the key name. This works
@@ -631,22 +3303,119 @@ def cfg(ui, repo, key=b'', value=None, **opts):
     from the file. You can put this in an active configuration file, or use the
     --config option to specify it for single use in the current command.
 
-    """
-    pattern = br"(?:([a-z_][a-z0-9_-]*)(?:\.([a-z_][a-z0-9._-]*))?)?$"
-    m = re.match(pattern, key, re.I)
-    if not m:
-        ui.warn(_(b"invalid key syntax. try SECTION.KEY\n"))
-        return
-    section = m.group(1)
-    key = m.group(2)
+    Replacing values without "hgcfg.delete_on_replace" leaves commented out
+    copies of the old values behind. To clean up a config file, run --compact:
+    it removes commented out copies of keys which are set, assignments of
+    keys which are assigned again later in the same section, and repeated
+    headers of a section, moving its contents up to its first header. The
+    values hg reads from the file stay the same. As when setting a value, the
+    local config file is used by default. With -n/--dry-run, the file is left
+    as it is, and only how many lines and bytes would be saved is reported.
+
+    To apply many changes to one config file at once, list them in a file
+    (or on stdin) and pass it with --batch, one operation per line:
+
+        set SECTION.KEY VALUE
+        delete SECTION.KEY
+        delete-section SECTION
+        rename-section OLD NEW
+
+    Operations are applied in order, reading and writing the config file only
+    once. The file to change is chosen as for setting a single value.
+
+    To see where the value hg uses for each key comes from, use --blame
+    (optionally with a SECTION). This takes all config files into account,
+    as well as values from environment variables and the --config option,
+    regardless of the --local, --user, and --global options.
+
+    To find values by their name or contents, use --grep with a regular
+    expression (optionally with a SECTION). Every value in the config files
+    in scope, and the files they include, whose SECTION.KEY name or value
+    matches is shown, with its scope, file and line. Use --keys or --values
+    to only search names or values.
+
+    To see how the config of another repository differs from this one, use
+    --diff with the path to the other repository (optionally with a SECTION).
+    Only the keys whose effective values differ are shown, each value with
+    where it comes from: '-' for this repository, '+' for the other one.
+    Instead of a repository, --diff also accepts two comma separated lists of
+    scopes, like "local:user,global", to compare the values set by the config
+    files in the first scopes with those set by the files in the second.
+
+    To tell whether the configs of many repositories are the same, compare
+    the digests shown by --digest. The digest depends on what each config
+    file sets, in the order they are read, but not on where the files are,
+    or on comments and formatting. With SECTIONs, it only depends on the
+    effective keys and values in those sections, not on which files set
+    them. With the --local, --user, or --global option, it only covers the
+    config files in those scopes. Values taken from environment variables
+    (like $EDITOR), the defaults bundled with hg and values given with
+    --config are left out, since they depend on how hg is run, unless
+    --all-sources is given. With --verbose, the digest of each config file
+    is shown as well, to find out which of them differ.
+
+    To copy config values to another machine or repository, write them out
+    with --export, and apply them there with --import. By default, --export
+    writes out the effective values set by all config files (in SECTION, if
+    given), grouped by scope, with the file and line each value comes from
+    in a comment. --import writes each value to a config file in the scope
+    it was exported from, or in the scopes given with the --local, --user,
+    or --global options. Each config file is written only once, and values
+    that are replaced are deleted or commented out like when setting them.
+
+    When showing sections or values, or with --grep, --limit shows only the
+    first N of them. Except with --quiet, where they are sorted, they are
+    shown as the config files are read, and config files are read only as
+    they are needed. To tell whether a value is active, the config files
+    read after the one it is in are read too, until one of them sets it
+    again.
+
+    If more than one writeable config file is found when setting values, the
+    --choice option selects one without asking, by its number in the list you
+    would otherwise have been asked to choose from.
+
+    To run any of the above for many repositories in one process, list their
+    paths in a file (or on stdin) and pass it with --repos. The output for
+    each repository is prefixed with its path, and a failure in one of them
+    does not stop the others. Use --jobs to process several repositories in
+    parallel. Writeable config files are never prompted for with --repos,
+    the first one is used unless --choice is given.
+
+    Parsed config files can be cached on disk between invocations by setting
+    "hgcfg.cache" to True. Cached results are only used for files which have
+    not changed since, judging by their modification time, size and inode. The
+    cache lives in "hgcfg.cache-dir", which defaults to an "hgcfg" directory in
+    the user's cache directory. Use --cache-stats to see what is in the cache,
+    and --cache-clear to empty it.
+
+    Processes which run many commands, like the command server, also keep up
+    to "hgcfg.warm-cache-size" (256 by default) parsed config files in memory
+    between commands, under the same conditions. The chg server, which runs
+    each command in a process of its own, keeps the global and user config
+    files parsed for them. Set it to 0 to turn this off.
+
+    Config files on network file systems, like NFS or sshfs, are looked up and
+    read by up to "hgcfg.io-workers" (4 by default) threads at once, rather
+    than one after another. Set it to 1 to turn this off. Files on local disks
+    are always read one after another.
+
+    When showing values, -T/--template formats each of them with a template,
+    which is given the scope, path, line, section, key and value, and whether
+    the value is the active one. Without a key, each value in the section is
+    given to it, and without a section, each section in each file (with its
+    scope and path). With --blame, the effective values are given instead.
+    Use -T json for JSON output.
+
+    With --profile-phases, or when "hgcfg.trace" is set, a report of how long
+    the command spent finding config files, checking them with stat, parsing
+    them, working out the active values and writing output is written to
+    stderr once it is done, along with how many files were stat'd, bytes read,
+    lines scanned and ui.write calls made. When "hgcfg.trace-json" names a
+    file, the report is also appended to it as a line of JSON.
 
-    if opts['delete']:  # Don't use bytestring
-        if value is not None:
-            ui.warn(_(b'must not specify NEW_VALUE with --delete option'))
-            return
-        if not section or not key:
-            ui.warn(_(b'must specify SECTION.KEY with --delete option'))
-            return
+    """
+    if opts['cache_stats'] or opts['cache_clear']:  # Don't use bytestring
+        return cachecmd(ui, **opts)
 
     default_get_scopes = {b'local', b'user', b'global'}
     default_set_scopes = {b'local'}
@@ -658,19 +3427,388 @@ def cfg(ui, repo, key=b'', value=None, **opts):
     if opts['global']:  # Don't use bytestring
         scopes.add(b'global')
 
-    # no value given, we will show them the value
-    if value is None and not opts['delete']:  # Don't use bytestring
-        showvalue(ui, repo, section, key, scopes or default_get_scopes)
-    # try to set a value
+    limit = opts['limit']  # Don't use bytestring
+    if limit:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise error.Abort(_(b'limit must be a positive integer'))
+        if limit <= 0:
+            raise error.Abort(_(b'limit must be positive'))
+    else:
+        limit = None
+
+    choice = opts['choice']  # Don't use bytestring
+    if choice < 0:
+        choice = 0 if opts['repos'] else None  # Don't use bytestring
+
+    if sections and not opts['digest']:  # Don't use bytestring
+        raise error.CommandError(b'cfg', _(b'invalid arguments'))
+
+    if opts['all_sources'] and not opts['digest']:  # Don't use bytestring
+        ui.warn(_(b'--all-sources can only be used with --digest\n'))
+        return
+
+    if opts['digest']:  # Don't use bytestring
+        sections = [s for s in (key, value) + sections if s]
+        for s in sections:
+            if splitkey(s) != (s, None):
+                ui.warn(_(b'can only specify SECTIONs with --digest option\n'))
+                return
+        if opts['all_sources'] and scopes:  # Don't use bytestring
+            ui.warn(_(b'--all-sources cannot be used with --local, --user '
+                      b'or --global\n'))
+            return
+
+        def run(ui, repo):
+            showdigest(ui, repo, set(sections), scopes or None,
+                       opts['all_sources'],  # Don't use bytestring
+                       template=opts['template'])  # Don't use bytestring
+    elif opts['import']:  # Don't use bytestring
+        if key or value is not None or opts['delete'] or opts['batch']:  # Don't use bytestring
+            ui.warn(_(b'must not specify SECTION.KEY, --delete or --batch with --import option\n'))
+            return
+        groups = readsnapshot(ui, opts['import'])  # Don't use bytestring
+        if not groups:
+            ui.status(_(b"no operations to apply\n"))
+            return
+
+        def run(ui, repo):
+            return importconfig(ui, repo, groups, scopes, choice)
+    elif opts['compact']:  # Don't use bytestring
+        if key or value is not None or opts['delete']:  # Don't use bytestring
+            ui.warn(_(b'must not specify SECTION.KEY or --delete with --compact option\n'))
+            return
+
+        def run(ui, repo):
+            return compactconfig(ui, repo, scopes or default_set_scopes,
+                                 choice, opts['dry_run'])  # Don't use bytestring
+    elif opts['batch']:  # Don't use bytestring
+        if key or value is not None or opts['delete']:  # Don't use bytestring
+            ui.warn(_(b'must not specify SECTION.KEY or --delete with --batch option\n'))
+            return
+        ops = readbatch(ui, opts['batch'])  # Don't use bytestring
+        if not ops:
+            ui.status(_(b"no operations to apply\n"))
+            return
+
+        def run(ui, repo):
+            if not writeops(ui, repo, ops, scopes or default_set_scopes, choice):
+                return False
+            ui.note(_(b"applied %d operations\n") % len(ops))
+            return True
     else:
-        # for these values, I think it's best to default to local config
-        writevalue(ui, repo, section, key, value, scopes or default_set_scopes)
-    # FIXME: --delete is not used.
+        # Names which aren't patterns must be valid section and key names,
+        # since they may be written.
+        if isglob(key):
+            m = _globkeyre.match(key)
+        else:
+            m = _keyre.match(key)
+        if not m:
+            ui.warn(_(b"invalid key syntax. try SECTION.KEY\n"))
+            return
+        section = m.group(1)
+        key = m.group(2)
+
+        if isglob(section) or isglob(key):
+            if (value is not None or opts['delete'] or opts['blame'] or  # Don't use bytestring
+                    opts['grep'] or opts['diff'] or opts['export']):  # Don't use bytestring
+                ui.warn(_(b"wildcards can only be used to show values\n"))
+                return
+
+        if opts['delete']:  # Don't use bytestring
+            if value is not None:
+                ui.warn(_(b'must not specify NEW_VALUE with --delete option'))
+                return
+            if not section or not key:
+                ui.warn(_(b'must specify SECTION.KEY with --delete option'))
+                return
+
+        if opts['blame']:  # Don't use bytestring
+            if key or value is not None or opts['delete']:  # Don't use bytestring
+                ui.warn(_(b'can only specify SECTION with --blame option\n'))
+                return
+
+            def run(ui, repo):
+                showblame(ui, repo, section, template=opts['template'])  # Don't use bytestring
+        elif opts['grep']:  # Don't use bytestring
+            if key or value is not None or opts['delete']:  # Don't use bytestring
+                ui.warn(_(b'can only specify SECTION with --grep option\n'))
+                return
+            try:
+                regex = util.re.compile(opts['grep'])  # Don't use bytestring
+            except re.error as inst:
+                raise error.Abort(_(b'invalid --grep pattern: %s')
+                                  % pycompat.bytestr(inst))
+            keys = opts['keys'] or not opts['values']  # Don't use bytestring
+            values = opts['values'] or not opts['keys']  # Don't use bytestring
+
+            def run(ui, repo):
+                showgrep(ui, repo, regex, scopes or default_get_scopes, section,
+                         keys, values, limit=limit,
+                         template=opts['template'])  # Don't use bytestring
+        elif opts['export']:  # Don't use bytestring
+            if key or value is not None or opts['delete']:  # Don't use bytestring
+                ui.warn(_(b'can only specify SECTION with --export option\n'))
+                return
+
+            def run(ui, repo):
+                exportconfig(ui, repo, scopes or default_get_scopes, section)
+        elif opts['diff']:  # Don't use bytestring
+            if key or value is not None or opts['delete']:  # Don't use bytestring
+                ui.warn(_(b'can only specify SECTION with --diff option\n'))
+                return
+
+            def run(ui, repo):
+                diffconfigs(ui, repo, opts['diff'], section,  # Don't use bytestring
+                            template=opts['template'])  # Don't use bytestring
+        elif opts['keys'] or opts['values']:  # Don't use bytestring
+            ui.warn(_(b'--keys and --values can only be used with --grep\n'))
+            return
+        # no value given, we will show them the value
+        elif value is None and not opts['delete']:  # Don't use bytestring
+            def run(ui, repo):
+                showvalue(ui, repo, section, key, scopes or default_get_scopes,
+                          limit=limit, template=opts['template'])  # Don't use bytestring
+        # try to set a value
+        else:
+            # for these values, I think it's best to default to local config
+            def run(ui, repo):
+                return writevalue(ui, repo, section, key, value,
+                                  scopes or default_set_scopes, choice)
+
+    if opts['repos']:  # Don't use bytestring
+        return fleet(ui, opts['repos'], opts['jobs'], run)  # Don't use bytestring
+    run(ui, repo)
     return
 
 
+def readbatch(ui, source, parse=parsebatch):
+    """
+    Reads operations for the --batch option of `cfg` from the named file (or
+    stdin for '-'), see `parsebatch`.
+    """
+    if source == b'-':
+        data = ui.fin.read()
+        source = b'<stdin>'
+    else:
+        with open(util.expandpath(source), 'rb') as f:
+            data = f.read()
+    return parse(data, source)
+
+
+def readsnapshot(ui, source):
+    """
+    Reads a snapshot for the --import option of `cfg` from the named file (or
+    stdin for '-'), see `parsesnapshot`.
+    """
+    return readbatch(ui, source, parsesnapshot)
+
+
+# The ui and function that `fleet` is running, for its workers to pick up.
+_fleetcommand = None
+
+
+def _fleetrun(path):
+    """
+    Runs the current `fleet` command for a single repository. Returns the
+    path, the output of the command, and an error message if it failed
+    (`None` otherwise).
+    """
+    ui, func = _fleetcommand
+    try:
+        repo = hg.repository(ui.copy(), util.expandpath(path))
+    except Exception as inst:
+        return path, b'', pycompat.bytestr(inst)
+
+    repo.ui.pushbuffer(error=True, labeled=True)
+    err = None
+    try:
+        if func(repo.ui, repo) is False:
+            err = _(b'command failed')
+    except Exception as inst:
+        err = pycompat.bytestr(inst)
+    finally:
+        output = repo.ui.popbuffer()
+        repo.close()
+    return path, output, err
+
+
+def _fleetinit():
+    """
+    Initializes a forked `fleet` worker process. The signal handlers hg
+    installs would turn the pool terminating its workers into errors.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _fleetpool(jobs):
+    """
+    Returns a pool of `jobs` workers for `fleet`: forked processes where that
+    is possible, and threads otherwise.
+    """
+    # Not imported up front, because it takes a while and is only needed for
+    # --jobs.
+    import multiprocessing
+    import multiprocessing.pool
+
+    if hasattr(os, 'fork'):
+        try:
+            return multiprocessing.get_context('fork').Pool(jobs, _fleetinit)
+        except AttributeError:
+            # Python 2 always forks.
+            return multiprocessing.Pool(jobs, _fleetinit)
+    return multiprocessing.pool.ThreadPool(jobs)
+
+
+def fleet(ui, source, jobs, func):
+    """
+    Runs `func(ui, repo)` for every repository listed in the file named by
+    `source` (or on stdin, for '-'), one path per line, using up to `jobs`
+    workers in parallel.
+
+    The output of each repository is written, in the order they are listed,
+    as soon as it is available, with every line prefixed by the repository's
+    path. The function is considered to have failed for a repository if it
+    raises an exception or returns False; that does not affect the others.
+    Returns 1 if it failed for any repository, 0 otherwise.
+    """
+    global _fleetcommand
+
+    if source == b'-':
+        data = ui.fin.read()
+    else:
+        with open(util.expandpath(source), 'rb') as f:
+            data = f.read()
+    paths = [l.strip() for l in data.splitlines()]
+    paths = [p for p in paths if p and not p.startswith(b'#')]
+
+    _fleetcommand = (ui, func)
+    pool = None
+    if jobs > 1 and len(paths) > 1:
+        jobs = min(jobs, len(paths))
+        pool = _fleetpool(jobs)
+        chunksize = max(1, min(16, len(paths) // (jobs * 4)))
+        results = pool.imap(_fleetrun, paths, chunksize)
+    else:
+        results = (_fleetrun(p) for p in paths)
+
+    failed = 0
+    try:
+        for path, output, err in results:
+            for line in output.splitlines():
+                ui.write(path + b': ', label=b'hgcfg.repo')
+                ui.write(line + b'\n')
+            if err is not None:
+                failed += 1
+                ui.warn(path + b': ', label=b'hgcfg.repo')
+                ui.warn(_(b'error: %s\n') % err)
+        if pool is not None:
+            pool.close()
+            pool.join()
+            pool = None
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        _fleetcommand = None
+
+    ui.status(_(b"%d repositories, %d failed\n") % (len(paths), failed))
+    return 1 if failed else 0
+
+
+def cachecmd(ui, **opts):
+    """
+    Implements the --cache-stats and --cache-clear options of `cfg`.
+    """
+    cache = getparsecache(ui, force=True)
+    if opts['cache_stats']:  # Don't use bytestring
+        stats = cache.stats()
+        ui.write(_(b'cache directory: %s\n') % cache.path)
+        ui.write(_(b'enabled: %s\n')
+                 % (ui.configbool(b'hgcfg', b'cache', False) and b'yes' or b'no'))
+        ui.write(_(b'entries: %d (%d fresh, %d stale)\n')
+                 % (stats[b'entries'], stats[b'fresh'], stats[b'stale']))
+        ui.write(_(b'size: %d bytes\n') % stats[b'bytes'])
+    if opts['cache_clear']:  # Don't use bytestring
+        warm = getwarmcache(ui)
+        if warm is not None:
+            warm.clear()
+        ui.status(_(b'removed %d cache entries\n') % cache.clear())
+
+
 # Some utility functions for writing to the UI
 
+class outputbuffer(object):
+    """
+    Stands in for `ui` when writing the output of a command, collecting it so
+    that it can be written with a few `ui.write` calls instead of one for
+    every token.
+
+    Labels are applied with `ui.label` as output comes in. Like `ui`, it
+    drops `status` output with --quiet and `note` output without --verbose,
+    and writes what is left of them with `ui.status`. Output is written once
+    `FLUSHSIZE` bytes have been collected, and when `flush` is called.
+    """
+    FLUSHSIZE = 64 * 1024
+
+    def __init__(self, ui):
+        self.ui = ui
+        self.quiet = ui.quiet
+        self.verbose = ui.verbose
+        self._chunks = []
+        self._size = 0
+        self._status = False
+
+    def _add(self, status, msgs, label):
+        if status != self._status:
+            self.flush()
+            self._status = status
+        for m in msgs:
+            if label:
+                m = self.ui.label(m, label)
+            self._chunks.append(m)
+            self._size += len(m)
+        if self._size >= self.FLUSHSIZE:
+            self.flush()
+
+    def write(self, *msgs, **opts):
+        self._add(False, msgs, opts.get('label', b''))  # Don't use bytestring
+
+    def status(self, *msgs, **opts):
+        if not self.quiet:
+            self._add(True, msgs, opts.get('label', b''))  # Don't use bytestring
+
+    def note(self, *msgs, **opts):
+        if self.verbose:
+            self._add(True, msgs, opts.get('label', b''))  # Don't use bytestring
+
+    def flush(self):
+        if self._chunks:
+            data = b''.join(self._chunks)
+            self._chunks = []
+            self._size = 0
+            if self._status:
+                self.ui.status(data)
+            else:
+                self.ui.write(data)
+
+
+def getformatter(ui, out, topic, opts):
+    """
+    Returns a formatter writing to `out` for the --template option in
+    `opts`, or None if hgcfg's own output should be written instead.
+    """
+    template = opts.get('template')  # Don't use bytestring
+    if not template:
+        return None
+    fm = formatter.formatter(ui, out, topic, {b'template': template})
+    if fm.isplain():
+        return None
+    return fm
+
+
 def uiwritescope(ui, config, func=None):
     if func is None:
         func = ui.write
@@ -707,27 +3845,140 @@ def uiwriteitem(ui, k, v, config=None, func=None, active=False):
     func(b'\n')
 
 
+# In-process API, for hooks and other extensions which would otherwise run
+# `hg cfg`. These use the same caches as the commands.
+
+@commandstate
+def lookup(ui, repo, section, key):
+    """
+    Returns every `configentry` assigned to the key, in the order hg reads
+    them, so that the last one is the active one: from environment variables,
+    the config files bundled with hg and the config files of the repository
+    (which may be `None`), followed by the value given with --config, if any.
+    Values which were `%unset` later on are left out. See `effectiveconfig`
+    for how the entries of values which do not come from config files look.
+    """
+    index = configindex([], getparsecache(ui), getwarmcache(ui))
+    entries = []
+    for kind, obj in iterlayers(ui, repo, index):
+        if kind == b'items':
+            entries.extend(configentry(v, source, None, b'env')
+                           for s, k, v, source in obj
+                           if s == section and k == key)
+            continue
+        if (section, key) in obj.unset:
+            del entries[:]
+        entries.extend(obj.values(section, key))
+    if ui.configsource(section, key) == b'--config':
+        entries.append(configentry(ui.config(section, key), b'--config', None,
+                                   b'override'))
+    return entries
+
+
+@commandstate
+def effective(ui, repo, section=None):
+    """
+    Returns a dictionary mapping each `(section, key)` pair (only those in
+    the given section, if any) to the `configentry` of its active value, see
+    `effectiveconfig`.
+    """
+    index = configindex([], getparsecache(ui), getwarmcache(ui))
+    return effectiveconfig(ui, repo, index, section)
+
+
+@commandstate
+def apply(ui, repo, ops, scopes=(b'local',), choice=0, rcfile=None):
+    """
+    Applies a sequence of operations, as described by `_rewriteplan`, to a
+    config file at once, like `cfg --batch`: to the given one, or else to the
+    `choice`-th writeable config file within the given scopes, without
+    asking. Operations can be parsed from text with `parsebatch`. Returns
+    whether the operations could be applied.
+    """
+    if rcfile is not None:
+        return writeopstofile(ui, repo, ops, rcfile)
+    return writeops(ui, repo, ops, set(scopes), choice)
+
+
 # Extensions Stuff
 
+def deprecatedalias(old_name, func):
+    """
+    Returns a function which runs `func` under its old, deprecated name, like
+    `deprecate.replace_deprecated` does. The `deprecate` module is only
+    imported once the old name is actually used.
+    """
+    @functools.wraps(func)
+    def alias(*args, **kwargs):
+        path = os.path.dirname(__file__)
+        if path not in sys.path:
+            sys.path.append(path)
+        from deprecate import deprecated
+
+        def old(*args, **kwargs):
+            return func(*args, **kwargs)
+        old.__name__ = old_name
+
+        code = getattr(func, '__wrapped__', func).__code__  # Don't use bytestring
+        dep = deprecated("Use '%s' instead." % func.__name__,
+                         code.co_filename, code.co_firstlineno + 1)
+        return dep(old)(*args, **kwargs)
+    alias.__name__ = old_name
+    return alias
+
+
+def wrapchgserver():
+    """
+    Makes the chg server warm the cache of its own process once it is
+    listening, and after each fork for the next command, since each command
+    is run by a worker forked from it, see `prewarm`.
+    """
+    try:
+        from mercurial import chgserver
+    except ImportError:
+        return
+
+    def bindsocket(orig, self, *args, **kwargs):
+        orig(self, *args, **kwargs)
+        prewarm(self.ui)
+
+    def newconnection(orig, self, *args, **kwargs):
+        orig(self, *args, **kwargs)
+        prewarm(self.ui)
+
+    handler = chgserver.chgunixservicehandler
+    extensions.wrapfunction(handler, 'bindsocket', bindsocket)  # Don't use bytestring
+    extensions.wrapfunction(handler, 'newconnection', newconnection)  # Don't use bytestring
+
+
+def serve(orig, ui, repo, *args, **opts):
+    if opts.get('cmdserver') == b'chgunix':  # Don't use bytestring
+        wrapchgserver()
+    return orig(ui, repo, *args, **opts)
+
+
+def uisetup(ui):
+    # chgserver is only imported by the chg server itself, rather than by
+    # every command.
+    extensions.wrapcommand(commands.table, b'serve', serve)
+
+
 # Add the deprecated command aliases.
-for name in [b"", b"edit", b"list"]:
-    tail = b"cfg"
-    otail = b"config"
-    key = name + tail
-    if key not in cmdtable:
-        tail += b"s"
-        otail += b"s"
-        key = name + tail
-
-    cmddef = list(cmdtable[key])
-    cmddef[0] = getattr(sys.modules[__name__], (name + otail).decode('ascii'))
-    cmdtable[name + otail] = tuple(cmddef)
+config = deprecatedalias('config', cfg)  # Don't use bytestring
+editconfig = deprecatedalias('editconfig', editcfg)  # Don't use bytestring
+listconfigs = deprecatedalias('listconfigs', listcfgs)  # Don't use bytestring
+cmdtable[b"config"] = (config,) + cmdtable[b"cfg"][1:]
+cmdtable[b"editconfig"] = (editconfig,) + cmdtable[b"editcfg"][1:]
+cmdtable[b"listconfigs"] = (listconfigs,) + cmdtable[b"listcfgs"][1:]
 
 # colors
 colortable = {
     # A section name, like [paths] or [ui].
     b'hgcfg.section': b'cyan',
 
+    # The path of a repository, prefixed to output with --repos.
+    b'hgcfg.repo': b'magenta',
+
     # Paths to config files.
 
     # Files with global scope.
@@ -755,6 +4006,12 @@ colortable = {
     b'hgcfg.scope.user': b'yellow bold',
     b'hgcfg.scope.local': b'green bold',
 
+    # Sources of values shown by `hg cfg --blame` which are not hgrc files:
+    # config files bundled with hg, environment variables and --config.
+    b'hgcfg.file.default': b'blue',
+    b'hgcfg.file.env': b'magenta',
+    b'hgcfg.file.override': b'cyan',
+
     # A key and it's value
     # The name of the key
     b'hgcfg.item.key': b'none',